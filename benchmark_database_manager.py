@@ -0,0 +1,273 @@
+"""
+Benchmarks for the hot paths of database_manager.
+
+Every benchmark runs on documents of a few sizes in a temporary folder and reports the throughput, the p50 and p99
+latency and the peak memory that was allocated by python during the benchmark. The results are saved as json so two
+runs can be compared:
+
+    python benchmark_database_manager.py --output before.json
+    python benchmark_database_manager.py --output after.json --compare before.json
+
+See python benchmark_database_manager.py --help for the sizes, thread counts, process counts and read/write ratios.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from database_manager import Database, zstandard
+
+COMPRESSIONS = ["gzip:1", "gzip:6", "gzip:9", "lzma:0", "lzma:6"] + (["zstd:3"] if zstandard is not None else [])
+SIZES = {"1K": 1024, "100K": 100 * 1024, "1M": 1024 * 1024, "10M": 10 * 1024 * 1024, "100M": 100 * 1024 * 1024}
+
+
+def make_document(size: int) -> dict:
+    """ Returns a dict of user records that is about size bytes as indented json. """
+    record = {"name": "quinten", "age": 0, "status": "cool", "tags": ["a", "b", "c"], "profile": {"city": "Amsterdam"}}
+    record_size = len(json.dumps({"user00000": record}, indent=4))
+    return {f"user{number:05}": dict(record, age=number) for number in range(max(1, size // record_size))}
+
+
+def percentile(latencies: list, fraction: float) -> float:
+    """ Returns the latency below which fraction of the latencies are, latencies has to be sorted. """
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def summarize(latencies: list, seconds: float, peak_memory: int = None) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "operations": len(latencies),
+        "throughput": len(latencies) / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_memory": peak_memory,
+    }
+
+
+def operations(name: str, size: int) -> dict:
+    """ Returns benchmark name -> function that does one operation on the document name. """
+    keys = list(make_document(min(size, 100 * 1024)))  # The first keys, they are the same for all sizes
+    counter = iter(range(10 ** 12))
+    database = Database(name)
+
+    def with_block():
+        with Database(name) as document:
+            document[random.choice(keys)]["age"] += 1
+
+    return {
+        "read": lambda: Database.read(name),
+        "write": lambda: Database.write(name, Database.read(name)),
+        "add": lambda: Database.add(name, random.choice(keys), {"age": next(counter)}),
+        "append": lambda: Database.append(name, next(counter)),
+        "contains": lambda: random.choice(keys) in database,
+        "with": with_block,
+        "create_backup": lambda: Database.create_backup([name], keep=2),
+    }
+
+
+def measure(operation, count: int, memory: bool = False) -> tuple:
+    """ Runs operation count times and returns the latencies, the seconds it took and the peak memory if memory. """
+    latencies = []
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(count):
+        before = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - before)
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return latencies, seconds, peak
+
+
+def mixed(name: str, size: int, count: int, ratio: float, seed: int) -> list:
+    """ Does count operations of which ratio are reads and the rest are adds. Returns the latencies. """
+    random.seed(seed)
+    functions = operations(name, size)
+    latencies = []
+    for _ in range(count):
+        operation = functions["read"] if random.random() < ratio else functions["add"]
+        before = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - before)
+    return latencies
+
+
+def process_worker(path: str, name: str, size: int, count: int, ratio: float, seed: int) -> tuple:
+    """ Runs the mixed workload in another process. Returns the latencies and when it started and stopped. """
+    Database.set_path(path)
+    Database.file_locks = True  # The locks of the other processes are not shared otherwise
+    start = time.time()
+    latencies = mixed(name, size, count, ratio, seed)
+    return latencies, start, time.time()
+
+
+def run_concurrent(name: str, size: int, count: int, ratio: float, threads: int = 1, processes: int = 0) -> dict:
+    """ Runs the mixed workload in threads or processes at the same time and summarizes all their latencies. """
+    latencies = []
+    if processes:
+        context = multiprocessing.get_context("spawn")  # Forking a process with running threads is not safe
+        with context.Pool(processes) as pool:
+            results = pool.starmap(process_worker, [(Database.my_path, name, size, count, ratio, seed)
+                                                    for seed in range(processes)])
+        for result, _, _ in results:
+            latencies += result
+        # Starting the processes is not part of the benchmark
+        return summarize(latencies, max(end for _, _, end in results) - min(start for _, start, _ in results))
+    start = time.perf_counter()
+    results = [None] * threads
+
+    def work(number):
+        results[number] = mixed(name, size, count, ratio, number)
+
+    workers = [threading.Thread(target=work, args=(number,)) for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    for result in results:
+        latencies += result
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def benchmark_compression(name: str, document: dict, compression: str, count: int, size_name: str, size: int,
+                          benchmarks: list = None) -> list:
+    """ Measures read and write of the document compressed with compression, like "gzip:1". The results also have
+        the size of the compressed file compared to the plain one.
+    """
+    compression, level = compression.split(":")
+    Database.create(name, document, replace=True)
+    plain_size = os.path.getsize(os.path.join(Database.my_path, name + ".json"))
+    old_level = Database.compression_levels[compression]
+    Database.compression, Database.compression_levels[compression] = compression, int(level)
+    results = []
+    try:
+        Database.create(name, document, replace=True)
+        ratio = os.path.getsize(os.path.join(Database.my_path, name + ".json")) / plain_size
+        for operation in ("read", "write"):
+            benchmark = f"{operation}_{compression}_{level}"
+            if benchmarks and benchmark not in benchmarks:
+                continue
+            latencies, seconds, _ = measure(operations(name, size)[operation], count)
+            results.append(dict(summarize(latencies, seconds), benchmark=benchmark, size=size_name, threads=1,
+                                processes=0, file_ratio=ratio))
+    finally:
+        Database.compression, Database.compression_levels[compression] = None, old_level
+    return results
+
+
+def run(sizes: list = ("1K", "100K", "1M"), threads: list = (1, 4), processes: list = (2,), ratios: list = (0.9, 0.5),
+        count: int = 50, benchmarks: list = None, compressions: list = COMPRESSIONS) -> dict:
+    """ Runs all the benchmarks and returns the results as a dict that can be saved as json. """
+    results = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"serializer": Database.serializer, "cache_size": Database.cache_size,
+                     "journal": Database.journal, "durability": Database.durability},
+        "results": [],
+    }
+    old_path = Database.my_path
+    directory = tempfile.mkdtemp()
+    try:
+        Database.set_path(directory)
+        for size_name in sizes:
+            size = SIZES[size_name] if size_name in SIZES else int(size_name)
+            name = f"benchmark_{size_name}"
+            document = make_document(size)
+            # Big documents get fewer operations so one run does not take forever
+            size_count = max(3, min(count, count * 1024 * 1024 // max(size, 1)))
+            for benchmark, operation in operations(name, size).items():
+                if benchmarks and benchmark not in benchmarks:
+                    continue
+                Database.create(name, dict(document, **{name: []}), replace=True)
+                latencies, seconds, _ = measure(operation, size_count)
+                _, _, peak = measure(operation, max(1, size_count // 10), memory=True)
+                results["results"].append(dict(summarize(latencies, seconds, peak), benchmark=benchmark,
+                                               size=size_name, threads=1, processes=0))
+            for compression in compressions:
+                results["results"] += benchmark_compression(name, document, compression, size_count, size_name, size,
+                                                            benchmarks)
+            for ratio in ratios:
+                for thread_count in threads:
+                    Database.create(name, dict(document, **{name: []}), replace=True)
+                    summary = run_concurrent(name, size, size_count, ratio, threads=thread_count)
+                    results["results"].append(dict(summary, benchmark=f"mixed_{ratio}", size=size_name,
+                                                   threads=thread_count, processes=0))
+                for process_count in processes:
+                    Database.create(name, dict(document, **{name: []}), replace=True)
+                    summary = run_concurrent(name, size, size_count, ratio, processes=process_count)
+                    results["results"].append(dict(summary, benchmark=f"mixed_{ratio}", size=size_name,
+                                                   threads=1, processes=process_count))
+    finally:
+        Database.set_path(old_path)
+        shutil.rmtree(directory)
+    return results
+
+
+def compare(results: dict, baseline: dict) -> list:
+    """ Returns a line for every result that is also in baseline with how much the throughput and p99 changed. """
+    def key(result):
+        return result["benchmark"], result["size"], result["threads"], result["processes"]
+
+    before = {key(result): result for result in baseline["results"]}
+    lines = []
+    for result in results["results"]:
+        old = before.get(key(result))
+        if old is None or not old["throughput"] or not old["p99_ms"]:
+            continue
+        lines.append(f"{'/'.join(map(str, key(result))):<32} throughput {result['throughput'] / old['throughput']:6.2f}x"
+                     f"  p99 {result['p99_ms'] / old['p99_ms']:6.2f}x")
+    return lines
+
+
+def run_benchmark():
+    """ The command line of the benchmarks. Equivalent to `poetry run benchmark`. """
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths of database_manager.")
+    parser.add_argument("--sizes", default="1K,100K,1M", help=f"Document sizes in bytes or {', '.join(SIZES)}.")
+    parser.add_argument("--threads", default="1,4", help="Thread counts for the mixed read/write workload.")
+    parser.add_argument("--processes", default="2", help="Process counts for the mixed read/write workload.")
+    parser.add_argument("--ratios", default="0.9,0.5", help="Fractions of the mixed workload that are reads.")
+    parser.add_argument("--count", type=int, default=50, help="Operations per benchmark for documents up to 1M.")
+    parser.add_argument("--benchmarks", default="", help="Only run these single operation benchmarks.")
+    parser.add_argument("--compressions", default=",".join(COMPRESSIONS),
+                        help="Compressions and levels to benchmark read and write with, like gzip:1.")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to save the results.")
+    parser.add_argument("--compare", help="Results of an earlier run to compare with.")
+    arguments = parser.parse_args()
+
+    def numbers(text, kind):
+        return [kind(part) for part in text.split(",") if part]
+
+    results = run(sizes=numbers(arguments.sizes, str), threads=numbers(arguments.threads, int),
+                  processes=numbers(arguments.processes, int), ratios=numbers(arguments.ratios, float),
+                  count=arguments.count, benchmarks=numbers(arguments.benchmarks, str),
+                  compressions=numbers(arguments.compressions, str))
+    for result in results["results"]:
+        memory = "" if result["peak_memory"] is None else f"  peak {result['peak_memory'] / 1024:10.0f} KB"
+        if "file_ratio" in result:
+            memory = f"  file {result['file_ratio'] * 100:9.1f} %"
+        print(f"{result['benchmark']:<14} {result['size']:>5} threads {result['threads']} processes "
+              f"{result['processes']}  {result['throughput']:10.1f} ops/s  p50 {result['p50_ms']:8.3f} ms"
+              f"  p99 {result['p99_ms']:8.3f} ms{memory}")
+    with open(arguments.output, "w") as output:
+        json.dump(results, output, indent=4)
+    if arguments.compare:
+        with open(arguments.compare) as baseline:
+            print("\n".join(compare(results, json.load(baseline))))
+
+
+if __name__ == '__main__':
+    run_benchmark()
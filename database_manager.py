@@ -1,18 +1,1263 @@
-import copy
+import asyncio
+import bisect
+import codecs
+import dataclasses
 import glob
+import gzip
+import hashlib
 import json
+import lzma
+import mmap
+import operator
+import re
 import time
+import typing
 import shutil
+import sys
 import os
-from multiprocessing import Lock
+import pickle
+import threading
+import weakref
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 
-from collections import UserDict
+from collections import OrderedDict, UserDict
+from collections.abc import Mapping
+from types import MappingProxyType
+
+try:
+    from types import UnionType as _UnionType  # int | None
+except ImportError:  # Before python 3.10 there is only typing.Union
+    _UnionType = typing.Union
+
+try:
+    import fcntl
+except ImportError:  # Windows, FileLock falls back to lock files that are created exclusively
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # The "orjson" serializer falls back to the json module
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # The "msgpack" serializer can not be used
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # The "zstd" compression can not be used
+    zstandard = None
 
 
 __author__ = 'Quinten Cabo'
 __license__ = 'GNUV2'
 
 
+class _Changes:
+    """ Remembers which top level keys of a document were changed inside a with statement. """
+    __slots__ = ("keys", "everything", "active")
+
+    def __init__(self):
+        self.keys = set()
+        self.everything = False
+        self.active = True
+
+    def __bool__(self):
+        return self.everything or bool(self.keys)
+
+
+class _TrackedDict(dict):
+    """ A dict that reports changes to a _Changes. Nested dicts and lists are only wrapped when they are accessed.
+        key is the top level key this dict is under or None if this is the document itself.
+    """
+    __slots__ = ("_changes", "_key")
+
+    def __init__(self, data, changes: _Changes, key=None):
+        super().__init__(data)
+        self._changes = changes
+        self._key = key
+
+    def __reduce_ex__(self, protocol):
+        return dict, (dict(self),)
+
+    def _changed(self, key):
+        if self._changes.active:
+            self._changes.keys.add(key if self._key is None else self._key)
+
+    def _wrap(self, key, value):
+        if self._changes.active and type(value) in (dict, list):
+            value = _tracked(value, self._changes, key if self._key is None else self._key)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def _wrap_all(self):
+        if self._changes.active:
+            for key, value in dict.items(self):
+                self._wrap(key, value)
+
+    def __getitem__(self, key):
+        return self._wrap(key, super().__getitem__(key))
+
+    def __iter__(self):
+        # Only defined so that dict(...), {**...} and copy.copy(...) do not copy the values in C but get them with
+        # __getitem__, otherwise changes to nested values of the copy are not seen
+        return super().__iter__()
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        self._wrap_all()
+        return super().values()
+
+    def items(self):
+        self._wrap_all()
+        return super().items()
+
+    def copy(self):
+        self._wrap_all()
+        return super().copy()
+
+    def __setitem__(self, key, value):
+        self._changed(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._changed(key)
+        super().__delitem__(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._changed(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._changed(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        if self._changes.active:
+            if self._key is None:
+                self._changes.everything = True
+            else:
+                self._changes.keys.add(self._key)
+        super().clear()
+
+
+class _TrackedList(list):
+    """ A list that reports changes to the top level key it is under. """
+    __slots__ = ("_changes", "_key")
+
+    def __init__(self, data, changes: _Changes, key):
+        super().__init__(data)
+        self._changes = changes
+        self._key = key
+
+    def __reduce_ex__(self, protocol):
+        return list, (list(self),)
+
+    def _changed(self):
+        if self._changes.active:
+            self._changes.keys.add(self._key)
+
+    def _wrap_all(self):
+        if self._changes.active:
+            for index, value in enumerate(list.__iter__(self)):
+                if type(value) in (dict, list):
+                    list.__setitem__(self, index, _tracked(value, self._changes, self._key))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            self._wrap_all()
+            return super().__getitem__(index)
+        value = super().__getitem__(index)
+        if self._changes.active and type(value) in (dict, list):
+            value = _tracked(value, self._changes, self._key)
+            list.__setitem__(self, index, value)
+        return value
+
+    def __iter__(self):
+        self._wrap_all()
+        return super().__iter__()
+
+    def __reversed__(self):
+        self._wrap_all()
+        return super().__reversed__()
+
+    def copy(self):
+        self._wrap_all()
+        return super().copy()
+
+    def __add__(self, other):
+        self._wrap_all()
+        return super().__add__(other)
+
+    def __mul__(self, other):
+        self._wrap_all()
+        return super().__mul__(other)
+
+    __rmul__ = __mul__
+
+
+def _tracking(name):
+    """ Makes a list method that marks the list as changed before it runs. """
+    method = getattr(list, name)
+
+    def tracked_method(self, *args, **kwargs):
+        self._changed()
+        return method(self, *args, **kwargs)
+
+    tracked_method.__name__ = name
+    return tracked_method
+
+
+for _name in ("__setitem__", "__delitem__", "__iadd__", "__imul__", "append", "extend", "insert", "pop", "remove",
+              "clear", "sort", "reverse"):
+    setattr(_TrackedList, _name, _tracking(_name))
+
+
+def _tracked(value, changes: _Changes, key):
+    """ Wraps a plain dict or list that is under the top level key. """
+    if type(value) is dict:
+        return _TrackedDict(value, changes, key)
+    return _TrackedList(value, changes, key)
+
+
+_MISSING = object()  # A field that is not in a record
+
+_OPERATORS = {"==": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt,
+              ">=": operator.ge}
+
+
+def _field(record, parts: list):
+    """ Returns the value at the path parts in record or _MISSING. Numbers in the path index lists. """
+    for part in parts:
+        if isinstance(record, dict):
+            record = record.get(part, _MISSING)
+        elif isinstance(record, list) and part.isdigit() and int(part) < len(record):
+            record = record[int(part)]
+        else:
+            return _MISSING
+        if record is _MISSING:
+            return _MISSING
+    return record
+
+
+def _sort_key(value):
+    """ Returns what indexes store for a value or None if the value can not be indexed.
+        Values of different types never compare equal so True is not 1 and None sorts before everything.
+    """
+    if value is None:
+        return 0, 0
+    if isinstance(value, bool):
+        return 1, value
+    if isinstance(value, (int, float)):
+        return 2, value
+    if isinstance(value, str):
+        return 3, value
+    return None
+
+
+def _matches(value, op: str, operand) -> bool:
+    """ Checks a query condition against the value of a field. """
+    if op == "in":
+        return any(_matches(value, "==", item) for item in operand)
+    if op == "!=":
+        return not _matches(value, "==", operand)
+    if value is _MISSING:
+        return False
+    key, other = _sort_key(value), _sort_key(operand)
+    if key is None or other is None:
+        return op == "==" and value == operand
+    if op != "==" and key[0] != other[0]:  # Only values of the same type can be ordered
+        return False
+    return _OPERATORS[op](key, other)
+
+
+class _Index:
+    """ The secondary indexes on the fields of the records in one document. Persisted in <name>.index.
+        A hash index can answer == and in. A sorted index can also answer <, <=, > and >=.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.signature = None  # The signature of the document the index is up to date with
+        self.fields = {}  # field -> "hash" or "sorted"
+        self.values = {}  # field -> {key: value}
+        self.keys = {}  # field -> {sort key of value: set of keys}
+        self.order = {}  # field -> sorted list of the sort keys in self.keys, only for sorted indexes
+
+    def add_field(self, field: str, kind: str, document: dict):
+        assert kind in ("hash", "sorted"), f"Unknown index kind {kind!r}."
+        self.fields[field] = kind
+        parts = field.split(".")
+        values = {}
+        for key, record in document.items():
+            value = _field(record, parts)
+            if value is not _MISSING and _sort_key(value) is not None:
+                values[key] = value
+        self.values[field] = values
+        self.__build(field)
+
+    def remove_field(self, field: str):
+        for part in (self.fields, self.values, self.keys, self.order):
+            part.pop(field, None)
+
+    def rebuild(self, document: dict):
+        for field, kind in self.fields.items():
+            self.add_field(field, kind, document)
+
+    def __build(self, field: str):
+        keys = {}
+        for key, value in self.values[field].items():
+            keys.setdefault(_sort_key(value), set()).add(key)
+        self.keys[field] = keys
+        if self.fields[field] == "sorted":
+            self.order[field] = sorted(keys)
+
+    def update(self, records: dict, changed):
+        """ Re-indexes the changed keys. records has the new record for every changed key that still exists. """
+        for field in self.fields:
+            parts = field.split(".")
+            values, keys, order = self.values[field], self.keys[field], self.order.get(field)
+            for key in changed:
+                old = values.pop(key, _MISSING)
+                if old is not _MISSING:
+                    sort_key = _sort_key(old)
+                    keys[sort_key].discard(key)
+                    if not keys[sort_key]:
+                        del keys[sort_key]
+                        if order is not None:
+                            del order[bisect.bisect_left(order, sort_key)]
+                new = _field(records[key], parts) if key in records else _MISSING
+                sort_key = None if new is _MISSING else _sort_key(new)
+                if sort_key is None:
+                    continue
+                values[key] = new
+                if sort_key not in keys:
+                    keys[sort_key] = set()
+                    if order is not None:
+                        bisect.insort(order, sort_key)
+                keys[sort_key].add(key)
+
+    def lookup(self, field: str, op: str, operand):
+        """ Returns the keys of the records that match or None if this index can not answer the condition. """
+        keys = self.keys[field]
+        if op == "in":
+            found = [self.lookup(field, "==", item) for item in operand]
+            return None if None in found else set().union(*found)
+        sort_key = _sort_key(operand)
+        if sort_key is None:
+            return None
+        if op == "==":
+            return set(keys.get(sort_key, ()))
+        order = self.order.get(field)
+        if order is None or op not in ("<", "<=", ">", ">="):
+            return None
+        rank = sort_key[0]  # Only values of the same type are compared
+        if op == "<":
+            start, stop = bisect.bisect_left(order, (rank,)), bisect.bisect_left(order, sort_key)
+        elif op == "<=":
+            start, stop = bisect.bisect_left(order, (rank,)), bisect.bisect_right(order, sort_key)
+        elif op == ">":
+            start, stop = bisect.bisect_right(order, sort_key), bisect.bisect_left(order, (rank + 1,))
+        else:
+            start, stop = bisect.bisect_left(order, sort_key), bisect.bisect_left(order, (rank + 1,))
+        return set().union(*(keys[sort_key] for sort_key in order[start:stop]))
+
+    def dumps(self) -> bytes:
+        return json.dumps({"signature": self.signature, "fields": self.fields, "values": self.values},
+                          separators=(",", ":")).encode()
+
+    @staticmethod
+    def loads(path: str, raw: bytes):
+        saved = json.loads(raw)
+        index = _Index(path)
+        index.signature = tuple(saved["signature"]) if saved["signature"] is not None else None
+        index.fields = saved["fields"]
+        index.values = saved["values"]
+        for field in index.fields:
+            index.__build(field)
+        return index
+
+
+def _type_name(schema) -> str:
+    return schema.__name__ if isinstance(schema, type) else str(schema).replace("typing.", "")
+
+
+def _same(value):
+    return value
+
+
+class _Schema:
+    """ A compiled schema of a document. The schema is the type of the whole document: a dataclass for a document
+        with fixed keys or Dict[str, X] for a document where every value is an X. Types can be nested dataclasses,
+        List, Dict, Optional, Union, Literal, Any, bool, int, float, str, dict, list and None.
+
+        Every type is compiled once into a check and a decode function. A check raises a TypeError when a value does
+        not match and returns the value as json, so dataclass instances become dicts. Only the values that have to
+        change are copied. A decode turns json that matches back into the dataclasses.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.__compiled = {}  # type -> (check, decode)
+        self.__items = {}  # key -> check of the items of the list under key, for append
+        self.fields = {}  # key -> type of the value under key in a dataclass document
+        self.required = set()  # The keys a dataclass document has to have
+        self.values = None  # The type of every value in a Dict document
+        if dataclasses.is_dataclass(schema):
+            hints = typing.get_type_hints(schema)
+            for field in dataclasses.fields(schema):
+                self.fields[field.name] = hints[field.name]
+                if field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING:
+                    self.required.add(field.name)
+        elif schema is dict or typing.get_origin(schema) is dict:
+            self.values = (typing.get_args(schema) or (str, typing.Any))[1]
+        else:
+            raise TypeError(f"A schema has to be a dataclass or a Dict, not {_type_name(schema)}.")
+        self.check, self.decode = self.compile(schema)
+
+    def compile(self, schema) -> tuple:
+        """ Returns the check and the decode function of schema. """
+        compiled = self.__compiled.get(schema)
+        if compiled is None:
+            compiled = self.__compiled[schema] = self.__compile(schema)
+        return compiled
+
+    def __compile(self, schema) -> tuple:
+        name = _type_name(schema)
+        origin, arguments = typing.get_origin(schema), typing.get_args(schema)
+
+        def fail(value):
+            raise TypeError(f" should be {name}, not {type(value).__name__}")
+
+        if schema is typing.Any or schema is object:
+            return _same, _same
+        if schema is None or schema is type(None):
+            def check(value):
+                if value is not None:
+                    fail(value)
+                return value
+            return check, _same
+        if schema in (bool, int, float, str, dict, list):
+            accepted = (int, float) if schema is float else schema  # A json number without a fraction is an int
+            exclude = bool if schema in (int, float) else None  # A bool is an int in python but not in json
+
+            def check(value):
+                if not isinstance(value, accepted) or value.__class__ is exclude:
+                    fail(value)
+                return value
+            return check, _same
+        if origin is typing.Literal:
+            def check(value):
+                if not any(value == option and type(value) is type(option) for option in arguments):
+                    raise TypeError(f" should be one of {', '.join(map(repr, arguments))}, not {value!r}")
+                return value
+            return check, _same
+        if origin is typing.Union or origin is _UnionType:
+            options = [self.compile(option) for option in arguments]
+
+            def matching(value):
+                inner = None  # The error of an option with the right type but something wrong inside
+                for option_check, option_decode in options:
+                    try:
+                        return option_check(value), option_decode
+                    except TypeError as error:
+                        if not str(error).startswith(" should be "):
+                            inner = inner or error
+                if inner is not None:
+                    raise inner
+                fail(value)
+
+            return (lambda value: matching(value)[0]), (lambda value: matching(value)[1](value))
+        if origin is list:
+            item_check, item_decode = self.compile(arguments[0])
+
+            def check(value):
+                if not isinstance(value, list):
+                    fail(value)
+                result = value
+                for index, item in enumerate(value):
+                    try:
+                        checked = item_check(item)
+                    except TypeError as error:
+                        raise TypeError(f"[{index}]{error}") from None
+                    if checked is not item:
+                        if result is value:
+                            result = list(value)
+                        result[index] = checked
+                return result
+            return check, (_same if item_decode is _same else lambda value: [item_decode(item) for item in value])
+        if origin is dict:
+            value_check, value_decode = self.compile(arguments[1])
+
+            def check(value):
+                if not isinstance(value, dict):
+                    fail(value)
+                result = value
+                for key, item in value.items():
+                    try:
+                        checked = value_check(item)
+                    except TypeError as error:
+                        raise TypeError(f".{key}{error}") from None
+                    if checked is not item:
+                        if result is value:
+                            result = dict(value)
+                        result[key] = checked
+                return result
+            if value_decode is _same:
+                return check, _same
+            return check, lambda value: {key: value_decode(item) for key, item in value.items()}
+        if dataclasses.is_dataclass(schema):
+            return self.__compile_dataclass(schema, name)
+        raise TypeError(f"{name} can not be used in a schema.")
+
+    def __compile_dataclass(self, schema, name: str) -> tuple:
+        compiled = []  # Filled after the fields are compiled, so a dataclass can contain itself
+        self.__compiled[schema] = (lambda value: compiled[0](value), lambda value: compiled[1](value))
+        hints = typing.get_type_hints(schema)
+        fields = {field.name: self.compile(hints[field.name]) for field in dataclasses.fields(schema)}
+        required = {field.name for field in dataclasses.fields(schema)
+                    if field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING}
+
+        def check(value):
+            if isinstance(value, schema):  # Encode it
+                result = {}
+                for key, (field_check, _) in fields.items():
+                    try:
+                        result[key] = field_check(getattr(value, key))
+                    except TypeError as error:
+                        raise TypeError(f".{key}{error}") from None
+                return result
+            if not isinstance(value, dict):
+                raise TypeError(f" should be {name}, not {type(value).__name__}")
+            result = value
+            for key, item in value.items():
+                field = fields.get(key)
+                if field is None:
+                    raise TypeError(f".{key} is not a field of {name}")
+                try:
+                    checked = field[0](item)
+                except TypeError as error:
+                    raise TypeError(f".{key}{error}") from None
+                if checked is not item:
+                    if result is value:
+                        result = dict(value)
+                    result[key] = checked
+            if len(value) < len(fields) and not required.issubset(value):
+                raise TypeError(f".{min(required.difference(value))} is missing")
+            return result
+
+        def decode(value):
+            if isinstance(value, schema):
+                return value
+            return schema(**{key: fields[key][1](item) for key, item in value.items()})
+
+        compiled += [check, decode]
+        return check, decode
+
+    def __type_of(self, key):
+        if self.values is not None:
+            return self.values
+        if key not in self.fields:
+            raise TypeError(f" is not a field of {_type_name(self.schema)}")
+        return self.fields[key]
+
+    def validate(self, data, changed=None):
+        """ Checks the keys in changed, or all of data if changed is None, and returns data as json.
+            data is only copied when a value in it has to change.
+        """
+        if not isinstance(data, dict):  # A dataclass document
+            return self.check(data)
+        if changed is None:
+            changed = data.keys() | self.required
+        result = data
+        for key in changed:
+            if key not in data:
+                if key in self.required:
+                    raise TypeError(f".{key} is missing")
+                continue
+            value = data[key]
+            try:
+                checked = self.compile(self.__type_of(key))[0](value)
+            except TypeError as error:
+                raise TypeError(f".{key}{error}") from None
+            if checked is not value:
+                if result is data:
+                    result = dict(data)
+                result[key] = checked
+        return result
+
+    def validate_record(self, record: list) -> list:
+        """ Checks an add ("s"), append ("a") or delete ("d") record and returns it with its value as json. """
+        key = record[1]
+        if record[0] == "d":
+            if key in self.required:
+                raise TypeError(f".{key} can not be deleted")
+            return record
+        if record[0] == "s":
+            try:
+                checked = self.compile(self.__type_of(key))[0](record[2])
+            except TypeError as error:
+                raise TypeError(f".{key}{error}") from None
+            return record if checked is record[2] else ["s", key, checked]
+        item_check = self.__items.get(key)
+        if item_check is None:
+            try:
+                item_check = self.__items[key] = self.__item_check(key)
+            except TypeError as error:
+                raise TypeError(f".{key}{error}") from None
+        try:
+            checked = item_check(record[2])
+        except TypeError as error:
+            raise TypeError(f".{key}[]{error}") from None
+        return record if checked is record[2] else ["a", key, checked]
+
+    def __item_check(self, key):
+        """ Returns the check of the items of the list under key. """
+        schema = self.__type_of(key)
+        options = typing.get_args(schema) if typing.get_origin(schema) in (typing.Union, _UnionType) else (schema,)
+        for option in options:
+            if option is list or option is typing.Any or option is object:
+                return _same
+            if typing.get_origin(option) is list:
+                return self.compile(typing.get_args(option)[0])[0]
+        raise TypeError(" is not a list")
+
+
+_WHITESPACE = re.compile(r"[ \t\r\n]*")
+_NUMBER = frozenset("0123456789.eE+-")  # Characters that can continue a json number
+_MAGIC = {"gzip": b"\x1f\x8b", "lzma": b"\xfd7zXZ\x00", "zstd": b"\x28\xb5\x2f\xfd"}  # How compressed files start
+
+
+def _compression_of(raw: bytes):
+    """ Returns the compression that raw, the start of a file is enough, is compressed with or None. """
+    for compression, magic in _MAGIC.items():
+        if raw.startswith(magic):
+            return compression
+    return None
+
+
+_CONTAINER = re.compile(rb"[ \t\r\n]*[{\[]")  # How a json document starts, msgpack never does
+
+
+class _Reader:
+    """ Parses json values one by one from a memory mapped document with the C json decoder.
+        Only a window of the document is decoded at a time. The window grows when a value does not fit in it.
+    """
+    window_size = 1024 * 1024
+    decoder = json.JSONDecoder()
+
+    def __init__(self, buffer, position: int = 0):
+        self.buffer = buffer
+        self.seek(position)
+
+    def seek(self, position: int, size: int = None):
+        """ Decodes the window that starts at the byte position. """
+        chunk = self.buffer[position:position + (size or _Reader.window_size)]
+        self.end = position + len(chunk)  # The byte position after the window
+        self.text, consumed = codecs.utf_8_decode(chunk, "strict", False)
+        self.ascii = self.text.isascii()  # Then characters and bytes are the same
+        self.offset = position
+        self.index = 0
+        self.counted = (0, 0)  # A character index in text and its byte index, to count bytes from
+        self.eof = position + consumed >= len(self.buffer)
+
+    def position(self) -> int:
+        """ Returns the byte position in the document of the current character. """
+        if self.ascii:
+            return self.offset + self.index
+        index, byte = self.counted if self.counted[0] <= self.index else (0, 0)
+        byte += len(self.text[index:self.index].encode())
+        self.counted = (self.index, byte)
+        return self.offset + byte
+
+    def __grow(self):
+        position = self.position()
+        # Double the bytes that are left so a window that is too small for one character still grows
+        self.seek(position, max(_Reader.window_size, 2 * (self.end - position)))
+
+    def peek(self) -> str:
+        """ Skips whitespace and returns the next character or "" at the end of the document. """
+        while True:
+            self.index = _WHITESPACE.match(self.text, self.index).end()
+            if self.index < len(self.text) or self.eof:
+                return self.text[self.index:self.index + 1]
+            self.__grow()
+
+    def take(self, expected: str) -> str:
+        character = self.peek()
+        if character not in expected:
+            raise ValueError(f"Expected one of {expected!r} at {self.position()} but got {character!r}.")
+        self.index += 1
+        return character
+
+    def value(self):
+        """ Parses the next value. A number at the end of the window could be cut off, like 0.5 to 0, so a number that
+            ends at the end of the window or is followed by more number characters is parsed again in a bigger window.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _Reader.decoder.raw_decode(self.text, self.index)
+                if self.eof or not isinstance(value, (int, float)) or value is True or value is False or \
+                        end < len(self.text) and self.text[end] not in _NUMBER:
+                    self.index = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.__grow()
+
+    def children(self):
+        """ Yields the keys of the object or the indexes of the array at the current position. The caller has to read
+            or skip the value with value() before taking the next key. Yields nothing for other values.
+        """
+        opening = self.peek()
+        if opening not in ("{", "["):
+            return
+        closing = "}" if opening == "{" else "]"
+        self.take(opening)
+        if self.peek() == closing:
+            self.take(closing)
+            return
+        index = 0
+        while True:
+            if opening == "{":
+                key = self.value()
+                self.take(":")
+                yield key
+            else:
+                yield index
+                index += 1
+            if self.take("," + closing) == closing:
+                return
+
+    def find(self, parts: list) -> bool:
+        """ Moves to the value at the path parts. Returns False if it is not there. """
+        for part in parts:
+            for key in self.children():
+                if key == part or str(key) == part:
+                    break
+                self.value()
+            else:
+                return False
+        return True
+
+
+def _replay(value, records: list):
+    """ Applies journal records for one top level key to its value, which can be _MISSING. """
+    for record in records:
+        if record[0] == "s":
+            value = record[2]
+        elif record[0] == "d":
+            value = _MISSING
+        elif record[0] == "a":
+            if value is _MISSING:
+                value = []
+            if isinstance(value, list):  # Skipped like in Database.__replay
+                value.append(record[2])
+    return value
+
+
+class LazyDocument(Mapping):
+    """
+    A read only view on a json document that only parses the values that are used.
+
+    The document is memory mapped and only the top level keys are found when the view is made. A value is parsed the
+    first time it is used and is then kept. Because writes replace the file the view keeps seeing the document as it
+    was when the view was made. Close the view, or use it in a with statement, to unmap the file.
+    """
+
+    def __init__(self, buffer, records: list = (), values: dict = None):
+        self.__buffer = buffer
+        self.__spans = {}
+        if buffer is not None:
+            reader = _Reader(buffer)
+            for key in reader.children():
+                reader.peek()
+                start = reader.position()
+                reader.value()
+                self.__spans[key] = (start, reader.position())
+        self.__values = dict(values or {})
+        self.__keys = dict.fromkeys(self.__spans)
+        self.__keys.update(dict.fromkeys(self.__values))
+        for record in records:
+            value = _replay(self.get(record[1], _MISSING), [record])
+            self.__spans.pop(record[1], None)
+            if value is _MISSING:
+                self.__values.pop(record[1], None)
+                self.__keys.pop(record[1], None)
+            else:
+                self.__values[record[1]] = value
+                self.__keys[record[1]] = None
+
+    def __getitem__(self, key):
+        if key in self.__values:
+            return self.__values[key]
+        start, end = self.__spans[key]
+        value = self.__values[key] = json.loads(self.__buffer[start:end])
+        return value
+
+    def __iter__(self):
+        return iter(self.__keys)
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __contains__(self, key):
+        return key in self.__keys
+
+    def loaded(self) -> list:
+        """ Returns the keys whose values have been parsed. """
+        return list(self.__values)
+
+    def close(self):
+        if self.__buffer is not None:
+            self.__buffer.close()
+            self.__buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class FileLock:
+    """
+    A lock on a lock file that works across processes, also processes that did not fork from each other.
+
+    It can be used like a normal lock for exclusive (writer) access. Use acquire_shared, release_shared or
+    the shared() context manager for shared (reader) access. Every acquire opens its own file descriptor so threads
+    in the same process also wait on each other.
+    Without fcntl the lock file is created exclusively and removed again on release. Shared access is then also
+    exclusive.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__exclusive_fd = None
+        self.__shared_fds = []
+        self.__fds_lock = threading.Lock()  # Guards the list of shared fds, not the file
+
+    def __try_lock(self, shared: bool):
+        """ Returns an fd that holds the lock or None if the lock is taken. """
+        if fcntl is None:
+            try:
+                return os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+            except FileExistsError:
+                return None
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def __lock(self, shared: bool, blocking: bool, timeout):
+        if blocking and timeout is None and fcntl is not None:
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            return fd
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.001
+        while True:
+            fd = self.__try_lock(shared)
+            if fd is not None or not blocking:
+                return fd
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                delay = min(delay, remaining)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def __unlock(self, fd: int):
+        if fcntl is None:
+            os.remove(self.path)
+        os.close(fd)  # Closing the fd releases the flock
+
+    def acquire(self, blocking: bool = True, timeout: float = None) -> bool:
+        """ Acquires the lock for exclusive access. Returns False if it could not be acquired in time. """
+        fd = self.__lock(False, blocking, timeout)
+        if fd is None:
+            return False
+        self.__exclusive_fd = fd
+        return True
+
+    def release(self):
+        fd, self.__exclusive_fd = self.__exclusive_fd, None
+        assert fd is not None, "You are trying to release a FileLock that is not acquired."
+        self.__unlock(fd)
+
+    def acquire_shared(self, blocking: bool = True, timeout: float = None) -> bool:
+        """ Acquires the lock for shared access. Returns False if it could not be acquired in time. """
+        fd = self.__lock(True, blocking, timeout)
+        if fd is None:
+            return False
+        with self.__fds_lock:
+            self.__shared_fds.append(fd)
+        return True
+
+    def release_shared(self):
+        with self.__fds_lock:
+            assert self.__shared_fds, "You are trying to release a FileLock that is not acquired shared."
+            fd = self.__shared_fds.pop()
+        self.__unlock(fd)
+
+    @contextmanager
+    def shared(self):
+        """ Context manager that holds the lock for shared access. """
+        self.acquire_shared()
+        try:
+            yield self
+        finally:
+            self.release_shared()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __repr__(self):
+        return f"<FileLock {self.path!r}>"
+
+
+class RWLock:
+    """
+    A reader-writer lock for threads. Many threads can hold it shared (readers) at the same time but only one thread
+    can hold it exclusive (writer). Once a writer is waiting no new readers get in so writers do not starve.
+
+    It can be used like a normal lock for exclusive access. Use acquire_shared, release_shared or the shared()
+    context manager for shared access. It is not reentrant.
+    """
+
+    def __init__(self):
+        self.__condition = threading.Condition(threading.Lock())
+        self.__readers = 0
+        self.__writer = False
+        self.__writers_waiting = 0
+
+    def acquire(self, blocking: bool = True, timeout: float = None) -> bool:
+        """ Acquires the lock for exclusive access. Returns False if it could not be acquired in time. """
+        with self.__condition:
+            self.__writers_waiting += 1
+            try:
+                if not self.__wait(lambda: not self.__writer and self.__readers == 0, blocking, timeout):
+                    return False
+            finally:
+                self.__writers_waiting -= 1
+            self.__writer = True
+            return True
+
+    def release(self):
+        with self.__condition:
+            assert self.__writer, "You are trying to release a RWLock that is not acquired."
+            self.__writer = False
+            self.__condition.notify_all()
+
+    def acquire_shared(self, blocking: bool = True, timeout: float = None) -> bool:
+        """ Acquires the lock for shared access. Returns False if it could not be acquired in time. """
+        with self.__condition:
+            if not self.__wait(lambda: not self.__writer and self.__writers_waiting == 0, blocking, timeout):
+                return False
+            self.__readers += 1
+            return True
+
+    def release_shared(self):
+        with self.__condition:
+            assert self.__readers > 0, "You are trying to release a RWLock that is not acquired shared."
+            self.__readers -= 1
+            if self.__readers == 0:
+                self.__condition.notify_all()
+
+    def __wait(self, predicate, blocking: bool, timeout) -> bool:
+        if not blocking:
+            return predicate()
+        if not self.__condition.wait_for(predicate, timeout):
+            self.__condition.notify_all()  # Readers might have been waiting on this writer
+            return False
+        return True
+
+    @contextmanager
+    def shared(self):
+        """ Context manager that holds the lock for shared access. """
+        self.acquire_shared()
+        try:
+            yield self
+        finally:
+            self.release_shared()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __repr__(self):
+        return f"<RWLock readers={self.__readers} writer={self.__writer}>"
+
+
+class _ShardLocks:
+    """ The locks of all the shards of a sharded document. They are always taken in the same order so taking them
+        can not deadlock with another thread that takes them all or with one that takes a single shard lock.
+    """
+
+    def __init__(self, locks: list):
+        self.locks = locks
+
+    def __acquire(self, shared: bool, blocking: bool, timeout) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        acquired = []
+        for lock in self.locks:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not (lock.acquire_shared if shared else lock.acquire)(blocking, remaining):
+                for acquired_lock in reversed(acquired):
+                    acquired_lock.release_shared() if shared else acquired_lock.release()
+                return False
+            acquired.append(lock)
+        return True
+
+    def acquire(self, blocking: bool = True, timeout: float = None) -> bool:
+        return self.__acquire(False, blocking, timeout)
+
+    def release(self):
+        for lock in reversed(self.locks):
+            lock.release()
+
+    def acquire_shared(self, blocking: bool = True, timeout: float = None) -> bool:
+        return self.__acquire(True, blocking, timeout)
+
+    def release_shared(self):
+        for lock in reversed(self.locks):
+            lock.release_shared()
+
+    @contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield self
+        finally:
+            self.release_shared()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class _TimedLock:
+    """ Wraps the lock of a document to report how long it was waited for and held. Used when instrumentation is on.
+        get_lock makes a new one every time, so when the lock is taken is kept in the class.
+    """
+    held = {}  # name -> when the lock was taken exclusive
+    held_shared = threading.local()  # .held is name -> when this thread took the lock shared
+
+    def __init__(self, lock, name: str, record):
+        self.lock = lock
+        self.name = name
+        self.record = record
+
+    def acquire(self, blocking: bool = True, timeout: float = None) -> bool:
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            _TimedLock.held[self.name] = time.perf_counter()
+            self.record(self.name, "lock_wait", _TimedLock.held[self.name] - start)
+        return acquired
+
+    def release(self):
+        start = _TimedLock.held.pop(self.name, None)
+        self.lock.release()
+        if start is not None:
+            self.record(self.name, "lock_hold", time.perf_counter() - start)
+
+    def acquire_shared(self, blocking: bool = True, timeout: float = None) -> bool:
+        start = time.perf_counter()
+        acquired = self.lock.acquire_shared(blocking, timeout)
+        if acquired:
+            held = _TimedLock.held_shared.__dict__.setdefault("held", {})
+            held.setdefault(self.name, []).append(time.perf_counter())
+            self.record(self.name, "lock_wait", held[self.name][-1] - start)
+        return acquired
+
+    def release_shared(self):
+        starts = _TimedLock.held_shared.__dict__.get("held", {}).get(self.name)
+        self.lock.release_shared()
+        if starts:  # Not there if another thread took it
+            self.record(self.name, "lock_hold", time.perf_counter() - starts.pop())
+
+    @contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield self
+        finally:
+            self.release_shared()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+_TIME_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)  # Seconds
+_SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024)  # Bytes
+
+
+def _freeze(value, strings: dict):
+    """ Returns value with dicts as read only MappingProxyTypes and lists as tuples. Keys are interned and equal
+        strings are made the same object with strings so they are only in memory once.
+    """
+    if isinstance(value, dict):
+        return MappingProxyType({sys.intern(key) if type(key) is str else key: _freeze(item, strings)
+                                 for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item, strings) for item in value)
+    if type(value) is str:
+        return strings.setdefault(value, value)
+    return value
+
+
+class _Watcher:
+    """ The top level keys that changed since a watch last looked. everything is True if they are not known. """
+    __slots__ = ("keys", "pending", "everything")
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.pending = set()
+        self.everything = False
+
+
+class _Group:
+    """ The add, append and delete records for one document that group commit writes together. """
+    __slots__ = ("records", "errors", "done")
+
+    def __init__(self):
+        self.records = []
+        self.errors = {}  # index in records -> the exception for that record
+        self.done = threading.Event()
+
+
+def _process_alive(pid: int) -> bool:
+    if os.name != "posix":  # os.kill would end the process on windows
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_TRANSACTIONS = ".transactions"  # The folder next to the documents with the manifests of the running transactions
+
+
+def _roll_forward(directory: str):
+    """ Finishes the renames of transactions that were committed by a process that stopped before it did them all.
+        A <pid>.<thread>.transaction file is only there once all the new files of a transaction are written.
+    """
+    for path in glob.iglob(os.path.join(directory, _TRANSACTIONS, "*.transaction")):
+        pid = int(os.path.basename(path).split(".")[0])
+        if pid != os.getpid() and _process_alive(pid):  # Still busy renaming
+            continue
+        with open(path) as manifest:
+            renames = json.load(manifest)
+        for temporary, target in renames:
+            if os.path.exists(os.path.join(directory, temporary)):
+                os.replace(os.path.join(directory, temporary), os.path.join(directory, target))
+        os.remove(path)
+
+
+_BACKUP = re.compile(r"\d{8}-\d{6}(-\d+)?")  # The folder names create_backup makes, a second number if it was taken
+
+
+def _shard_count(path: str) -> int:
+    with open(path) as manifest:
+        return json.load(manifest)["shards"]
+
+
+def _is_name(name) -> bool:
+    """ Returns if name can be the name of a document, so it can not point to a file outside of the folder. """
+    return isinstance(name, str) and name not in ("", ".", "..") and os.sep not in name and \
+        (os.altsep is None or os.altsep not in name)
+
+
+class _Registry(dict):
+    """
+    name -> value for the documents with a <name><extension> file in directory. Documents are looked up on disk the
+    first time they are used, so nothing is read when the module is imported and documents that other processes
+    create are found without a restart. discover() adds all of them at once.
+
+    load makes the value from the path of the file. Names that are in skip are never looked up and neither are names
+    with a path in them, like "../secret".
+    """
+
+    def __init__(self, directory: str, extension: str, load, skip: dict = None):
+        super().__init__()
+        self.directory = directory
+        self.extension = extension
+        self.load = load
+        self.skip = skip
+        self.__lock = threading.Lock()
+
+    def __missing__(self, name):
+        if not self.__find(name):
+            raise KeyError(name)
+        return dict.__getitem__(self, name)
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or self.__find(name)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def __find(self, name) -> bool:
+        if not _is_name(name) or self.skip is not None and dict.__contains__(self.skip, name):
+            return False
+        path = os.path.join(self.directory, name + self.extension)
+        if not os.path.isfile(path):
+            return False
+        with self.__lock:
+            if not dict.__contains__(self, name):  # Another thread can have found it first
+                dict.__setitem__(self, name, self.load(path))
+        return True
+
+    def discover(self):
+        """ Adds all the documents in directory. """
+        for path in glob.iglob(os.path.join(glob.escape(self.directory), "*" + self.extension)):
+            self.__find(os.path.basename(path)[:-len(self.extension)])
+
+
 class Database(UserDict):
     """
     This class is used to write and read stuff with a database made out of local json files
@@ -49,8 +1294,90 @@ class Database(UserDict):
     my_path = os.path.dirname(os.path.realpath(__file__))  # Get the place of this file with realpath
     backup_folder_path = os.path.join(my_path, backup_directory_name)
     
-    # generate locks
-    locks = {os.path.basename(file[:-5]): Lock() for file in glob.iglob(os.path.join(my_path, "*.json"))}
+    # The locks of the documents. A lock is made the first time a document is used. Use set_path to use
+    # another folder for the documents.
+    locks = _Registry(my_path, ".json", lambda path: RWLock())
+
+    # Sharded documents are split over <name>.shard<i>.json by a hash of the top level keys. Every shard is a normal
+    # document with its own lock. <name>.shards has the amount of shards. See create.
+    __shards = _Registry(my_path, ".shards", _shard_count, skip=locks)
+
+    # Set file_locks to True to use a FileLock on <name>.lock for every document instead of the locks above.
+    # These also work between processes that did not fork from each other like gunicorn workers. The locks above only
+    # work in one process, so file_locks is turned on by itself when this process forks, see the end of the module.
+    file_locks = False
+    __file_locks = {}
+
+    # Set cache_size to the amount of bytes the in memory document cache may use. 0 turns the cache off.
+    cache_size = 0
+    __cache = OrderedDict()  # name -> (signature, payload) with the least recently used document first
+    __cache_lock = threading.Lock()
+    __cache_used = 0
+    __cache_hits = 0
+    __cache_misses = 0
+
+    # Set journal to True to make add, append and delete write small records to <name>.wal instead of rewriting
+    # <name>.json. The journal is merged back into <name>.json when it is bigger than journal_compact_size bytes or
+    # bigger than journal_compact_ratio times the size of <name>.json.
+    journal = False
+    journal_compact_size = 1024 * 1024
+    journal_compact_ratio = 1.0
+
+    # How sure a write is to be on disk when it returns. Writes are always atomic, readers see the old or the new file.
+    # "none": leave it to the OS, "file": fsync the file, "directory": fsync the file and the directory after the
+    # rename so the rename itself also survives a power loss.
+    durability = "none"
+
+    # The serializer that writes documents: "json", "orjson" (falls back to json if it is not installed) or "msgpack".
+    # Use serializers to pick one for a single document, like Database.serializers["events"] = "msgpack".
+    # Reads detect the format by themselves so you can switch at any time.
+    serializer = "json"
+    serializers = {}
+    # Set compact to True to write json without indentation and without sorting the keys. This is smaller and faster.
+    compact = False
+
+    # Set compression to "gzip", "lzma" or "zstd" (needs zstandard) to compress documents on disk. Use compressions to
+    # pick one for a single document, like Database.compressions["events"] = "gzip". Reads detect compressed documents
+    # by themselves. Compressed documents can not be streamed, get_path, iter_items and lazy read them whole.
+    # The levels are fast ones, see the compression benchmarks in benchmark_database_manager.py. On a 10 MB document
+    # gzip 1 and lzma 0 made reads and writes at most ~15% slower, because json itself is much slower. The higher
+    # levels made the files no smaller and lzma 6 made writes more than twice as slow.
+    compression = None
+    compressions = {}
+    compression_levels = {"gzip": 1, "lzma": 0, "zstd": 3}
+    # Backups of documents that are not compressed are compressed with this. None makes backups hard links again.
+    backup_compression = "gzip"
+
+    # Set group_commit to True to merge the add, append and delete calls on the same document that come in within
+    # group_commit_window seconds into one read and one write. Every call still returns after its change is written.
+    group_commit = False
+    group_commit_window = 0.002
+    __groups = {}  # name -> _Group that other calls can still join
+    __group_lock = threading.Lock()
+
+    # Set instrumentation to True to measure, per document, how long the locks are waited for and held and how long
+    # reading, parsing, serializing and writing take. See stats. Every hook in hooks is called with
+    # (name, metric, value) for every measurement. When instrumentation is off nothing is measured.
+    instrumentation = False
+    hooks = []
+    __stats = {}  # name -> metric -> [count, total, max, histogram]
+    __stats_lock = threading.Lock()
+
+    # How often watch checks if another process changed a document, in seconds.
+    watch_interval = 0.1
+    __watchers = {}  # name -> [_Watcher]
+    __watch_condition = threading.Condition()
+
+    __snapshots = {}  # name -> (signature, frozen document) see snapshot
+    __snapshot_locks = {}  # name -> lock so a snapshot is only built once at a time
+
+    # The schemas of the documents, name -> a dataclass or Dict[str, X]. See create. Writes that do not match raise a
+    # TypeError and are not written. Schemas are not saved, so every process has to set them.
+    schemas = {}
+    __schemas = {}  # name -> _Schema, the schema compiled once
+
+    __indexes = {}  # name -> _Index for the documents whose <name>.index was loaded
+    __index_lock = threading.Lock()
 
     @staticmethod
     def info():
@@ -61,21 +1388,57 @@ class Database(UserDict):
             "locks": Database.locks
         }
 
-    def __init__(self, filename: str):
+    @staticmethod
+    def set_path(path: str):
+        """ Makes path the folder with the documents. Do this before the documents are used.
+            The backup folder moves with it unless backup_folder_path was changed.
+        """
+        path = os.path.realpath(path)
+        if Database.backup_folder_path == os.path.join(Database.my_path, Database.backup_directory_name):
+            Database.backup_folder_path = os.path.join(path, Database.backup_directory_name)
+        Database.my_path = path
+        for registry in (Database.locks, Database.__shards):
+            registry.clear()
+            registry.directory = path
+        Database.__file_locks.clear()
+        Database.__snapshots.clear()
+        Database.clear_cache()
+        with Database.__index_lock:
+            Database.__indexes.clear()
+        _roll_forward(path)
+
+    def __init__(self, filename: str, readonly: bool = False):
         self.__name = filename
+        self.__readonly = readonly  # A readonly with statement holds the lock shared and never writes
         self.__in_with = False  # This is a boolean which is true when the Object __enter__ has been called and __exit__ has not yet been called. Used for __contains__
+        self.__changes = None  # The top level keys that changed in the current with statement
+        self.__held = None  # The lock __enter__ acquired, get_lock can give another one after a fork
         super().__init__()
 
     @property
     def lock(self):
         """Returns appropriate lock for file with self.name."""
-        assert self.name in Database.locks, "You are trying to acces a database that does not exist."
-        return Database.locks[self.name]
+        assert self.name in Database.locks or self.name in Database.__shards, \
+            "You are trying to acces a database that does not exist."
+        return Database.get_lock(self.name)
 
     @staticmethod
     def get_lock(name: str):
-        """Returns lock based on input name."""
-        return Database.locks[name]
+        """Returns lock based on input name. For a sharded document this takes the locks of all the shards."""
+        if name in Database.__shards:
+            # Sorted like in transaction so the two can not deadlock
+            return _ShardLocks([Database.get_lock(shard) for shard in sorted(Database.__shard_names(name))])
+        if not Database.file_locks:
+            lock = Database.locks[name]
+        else:
+            lock = Database.__file_locks.get(name)
+            if lock is None:
+                Database.locks[name]  # Only make locks for documents that exist
+                lock_path = os.path.join(Database.my_path, name + ".lock")
+                lock = Database.__file_locks.setdefault(name, FileLock(lock_path))
+        if Database.instrumentation:
+            return _TimedLock(lock, name, Database.__record)
+        return lock
 
     @property
     def name(self):
@@ -84,24 +1447,534 @@ class Database(UserDict):
 
     @name.setter
     def name(self, name: str):
-        assert name in Database.locks, "You are trying to switch to a name that does not exist in the database."
+        assert name in Database.locks or name in Database.__shards, \
+            "You are trying to switch to a name that does not exist in the database."
         self.__name = name
 
+    @staticmethod
+    def __shard_names(name: str) -> list:
+        return [f"{name}.shard{shard}" for shard in range(Database.__shards[name])]
+
+    @staticmethod
+    def __route(name: str, key) -> str:
+        """ Returns the shard of <name> that key is in or name itself if it is not sharded. """
+        shards = Database.__shards.get(name)
+        if not shards:
+            return name
+        # crc32 instead of hash() because hash() of a str is different in every process
+        return f"{name}.shard{zlib.crc32(str(key).encode()) % shards}"
+
     @staticmethod
     def read(name: str):
-        """Will read <name>.json with a lock. Do not run in other lock that will cause deadlock"""
-        with Database.get_lock(name):
+        """Will read <name>.json with a shared lock. Do not run in other lock that will cause deadlock"""
+        with Database.get_lock(name).shared():
             database = Database.__read(name)
         return database
 
     @staticmethod
     def __read(name: str):
         """ Will read <name>.json without a lock. Maybe rename this to _read_unsafe? """
-        database_path = os.path.join(os.path.dirname(__file__), name + ".json")
-        with open(database_path, "r+") as database_file:
-            database = json.load(database_file)
+        if name in Database.__shards:
+            database = {}
+            for shard in Database.__shard_names(name):
+                database.update(Database.__read(shard))
+            return database
+        if Database.cache_size <= 0:
+            return Database.__load(name)
+
+        # Stat before reading so a write that happens during the read can only cause an extra miss later
+        signature = Database.__signature(name)
+        database = Database.__cache_get(name, signature)
+        if database is None:
+            database = Database.__load(name)
+            Database.__cache_put(name, signature, pickle.dumps(database, pickle.HIGHEST_PROTOCOL), True)
+        return database
+
+    @staticmethod
+    def __load(name: str):
+        """ Parses <name>.json and replays <name>.wal over it if there is a journal. """
+        database_path = os.path.join(Database.my_path, name + ".json")
+        with open(database_path, "rb") as database_file:
+            if not Database.instrumentation:
+                database = Database.__decode(database_file.read())
+            else:
+                start = time.perf_counter()
+                raw = database_file.read()
+                read = time.perf_counter()
+                database = Database.__decode(raw)
+                Database.__record(name, "read", read - start, len(raw))
+                Database.__record(name, "parse", time.perf_counter() - read)
+            records = Database.__journal_records(name, os.fstat(database_file.fileno()))
+        return Database.__replay(database, records)
+
+    @staticmethod
+    def __replay(database: dict, records: list) -> dict:
+        """ Applies journal records to database. An append to a value that is not a list is skipped, without the
+            journal that append would have raised before anything was written.
+        """
+        for record in records:
+            if record[0] == "s":
+                database[record[1]] = record[2]
+            elif record[0] == "a":
+                value = database.setdefault(record[1], [])
+                if isinstance(value, list):
+                    value.append(record[2])
+            elif record[0] == "d":
+                database.pop(record[1], None)
+        return database
+
+    @staticmethod
+    def __journal_records(name: str, stat) -> list:
+        """ Returns the records in <name>.wal that belong to the version of <name>.json with stat. """
+        try:
+            journal_file = open(os.path.join(Database.my_path, name + ".wal"))
+        except FileNotFoundError:
+            return []
+        records = []
+        with journal_file:
+            # A journal that was started on another version of <name>.json is already merged into it
+            if journal_file.readline() != json.dumps(["h", stat.st_mtime_ns, stat.st_size, stat.st_ino]) + "\n":
+                return records
+            for line in journal_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:  # Only the last record can be half written when the process died during an append
+                    break
+        return records
+
+    @staticmethod
+    def __open_stream(name: str):
+        """ Memory maps <name>.json and reads its journal records with a shared lock.
+            Returns None for the buffer if the document is not json, then it can only be read whole.
+        """
+        database_path = os.path.join(Database.my_path, name + ".json")
+        with Database.get_lock(name).shared():
+            with open(database_path, "rb") as database_file:
+                stat = os.fstat(database_file.fileno())
+                records = Database.__journal_records(name, stat)
+                if stat.st_size == 0:
+                    raise ValueError(f"{name}.json is empty.")
+                buffer = mmap.mmap(database_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if not _CONTAINER.match(buffer):
+            buffer.close()
+            return None, records
+        return buffer, records
+
+    @staticmethod
+    def lazy(name: str) -> LazyDocument:
+        """ Returns a LazyDocument for <name>.json that only parses the values that are used. """
+        buffer, records = (None, None) if name in Database.__shards else Database.__open_stream(name)
+        if buffer is None:
+            return LazyDocument(None, values=Database.read(name))
+        return LazyDocument(buffer, records)
+
+    @staticmethod
+    def get_path(name: str, path):
+        """ Returns the value at path in <name>.json, like "users.quinten.status" or ["users", "quinten"],
+            without parsing the rest of the document. Numbers in the path index lists. Raises a KeyError if the
+            path is not there.
+        """
+        parts = path.split(".") if isinstance(path, str) else [str(part) for part in path]
+        if name in Database.__shards:
+            return Database.get_path(Database.__route(name, parts[0]), parts)
+        buffer, records = Database.__open_stream(name)
+        if buffer is None:
+            value = _field(Database.read(name), parts)
+        else:
+            try:
+                value = Database.__stream_value(buffer, records, parts)
+            finally:
+                buffer.close()
+        if value is _MISSING:
+            raise KeyError(path)
+        return value
+
+    @staticmethod
+    def iter_items(name: str, path=None):
+        """ Yields key, value for the object at path in <name>.json or index, value for a list. Values are parsed
+            one at a time so the document does not have to fit in memory. Without a path the whole document is used.
+            For the list that append adds to use the name of the document as path.
+        """
+        parts = [] if path is None else path.split(".") if isinstance(path, str) else [str(part) for part in path]
+        if name in Database.__shards:
+            for shard in [Database.__route(name, parts[0])] if parts else Database.__shard_names(name):
+                yield from Database.iter_items(shard, parts)
+            return
+        buffer, records = Database.__open_stream(name)
+        if buffer is None:
+            value = _field(Database.read(name), parts)
+            if value is _MISSING:
+                raise KeyError(path)
+            yield from value.items() if isinstance(value, dict) else enumerate(value)
+            return
+
+        try:
+            if parts and any(record[1] == parts[0] for record in records):
+                # Changed in the journal so it has to be parsed, only that part of the document
+                value = Database.__stream_value(buffer, records, parts)
+                if value is _MISSING:
+                    raise KeyError(path)
+                yield from value.items() if isinstance(value, dict) else enumerate(value)
+                return
+            if not parts:
+                touched = {}
+                for record in records:
+                    touched.setdefault(record[1], []).append(record)
+                reader = _Reader(buffer)
+                for key in reader.children():
+                    value = reader.value()
+                    if key in touched:
+                        value = _replay(value, touched.pop(key))
+                    if value is not _MISSING:
+                        yield key, value
+                for key, key_records in touched.items():  # Keys that were added in the journal
+                    value = _replay(_MISSING, key_records)
+                    if value is not _MISSING:
+                        yield key, value
+                return
+            reader = _Reader(buffer)
+            if not reader.find(parts):
+                raise KeyError(path)
+            for key in reader.children():
+                yield key, reader.value()
+        finally:
+            buffer.close()
+
+    @staticmethod
+    def __stream_value(buffer, records: list, parts: list):
+        """ Parses only the value at parts from buffer with the journal records applied. """
+        if not parts:
+            return Database.__decode(buffer[:]) if not records else dict(LazyDocument(buffer, records).items())
+        key_records = [record for record in records if record[1] == parts[0]]
+        reader = _Reader(buffer)
+        if not key_records:
+            return reader.value() if reader.find(parts) else _MISSING
+        value = _replay(reader.value() if reader.find(parts[:1]) else _MISSING, key_records)
+        return _MISSING if value is _MISSING else _field(value, parts[1:])
+
+    @staticmethod
+    def __encode(name: str, data) -> bytes:
+        """ Serializes data with the serializer for <name>. Raises a TypeError if data can not be serialized. """
+        if not Database.instrumentation:
+            return Database.__serialize(name, data)
+        start = time.perf_counter()
+        raw = Database.__serialize(name, data)
+        Database.__record(name, "serialize", time.perf_counter() - start)
+        return raw
+
+    @staticmethod
+    def __serialize(name: str, data) -> bytes:
+        return Database.__compress(Database.compressions.get(name, Database.compression), Database.__dump(name, data))
+
+    @staticmethod
+    def __dump(name: str, data) -> bytes:
+        serializer = Database.serializers.get(name, Database.serializer)
+        if serializer == "msgpack":
+            assert msgpack is not None, "The msgpack serializer needs msgpack to be installed."
+            return msgpack.packb(data, use_bin_type=True)
+        assert serializer in ("json", "orjson"), f"Unknown serializer {serializer!r}."
+        if serializer == "orjson" and orjson is not None:
+            if Database.compact:
+                return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+        if Database.compact:
+            return json.dumps(data, separators=(",", ":")).encode()
+        return json.dumps(data, indent=4, sort_keys=True).encode()
+
+    @staticmethod
+    def __decode(raw: bytes):
+        """ Parses a serialized document. Json always starts with whitespace or an ascii value, msgpack never does. """
+        compression = _compression_of(raw)
+        if compression is not None:
+            raw = Database.__decompress(compression, raw)
+        if raw[:1] and raw[:1] not in b' \t\r\n{["-0123456789tfn':
+            assert msgpack is not None, "This document is msgpack but msgpack is not installed."
+            return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+        if orjson is not None:
+            try:
+                return orjson.loads(raw)
+            except orjson.JSONDecodeError:  # Things orjson does not accept like NaN, json will raise if it is malformed
+                pass
+        return json.loads(raw)
+
+    @staticmethod
+    def __compress(compression, raw: bytes) -> bytes:
+        if compression is None:
+            return raw
+        level = Database.compression_levels[compression]
+        if compression == "gzip":
+            return gzip.compress(raw, level, mtime=0)  # mtime 0 so the same document always gives the same bytes
+        if compression == "lzma":
+            return lzma.compress(raw, preset=level)
+        assert compression == "zstd", f"Unknown compression {compression!r}."
+        assert zstandard is not None, "The zstd compression needs zstandard to be installed."
+        return zstandard.ZstdCompressor(level=level).compress(raw)
+
+    @staticmethod
+    def __compressor(compression, file):
+        """ Returns a file that compresses what is written to it into file. """
+        level = Database.compression_levels[compression]
+        if compression == "gzip":
+            return gzip.GzipFile("", "wb", level, file, mtime=0)
+        if compression == "lzma":
+            return lzma.LZMAFile(file, "wb", preset=level)
+        assert compression == "zstd", f"Unknown compression {compression!r}."
+        assert zstandard is not None, "The zstd compression needs zstandard to be installed."
+        return zstandard.ZstdCompressor(level=level).stream_writer(file, closefd=False)
+
+    @staticmethod
+    def __decompress(compression: str, raw: bytes) -> bytes:
+        if compression == "gzip":
+            return gzip.decompress(raw)
+        if compression == "lzma":
+            return lzma.decompress(raw)
+        assert zstandard is not None, "This document is compressed with zstd but zstandard is not installed."
+        return zstandard.ZstdDecompressor().decompressobj().decompress(raw)
+
+    @staticmethod
+    def __journal(name: str, records: list, text: str):
+        """ Appends records, serialized as text, to <name>.wal without a lock and compacts the journal if it got too
+            big.
+        """
+        database_path = os.path.join(Database.my_path, name + ".json")
+        before = Database.__signature(name) if name in Database.__indexes else None
+        stat = os.stat(database_path)
+        header = json.dumps(["h", stat.st_mtime_ns, stat.st_size, stat.st_ino]) + "\n"
+        start = time.perf_counter() if Database.instrumentation else None
+        with open(os.path.join(Database.my_path, name + ".wal"), "a+") as journal_file:
+            if journal_file.tell() > 0:
+                journal_file.seek(0)
+                if journal_file.readline() != header:  # Left behind by a compaction that did not get to remove it
+                    journal_file.truncate(0)
+            new_journal = journal_file.seek(0, os.SEEK_END) == 0
+            if new_journal:
+                journal_file.write(header)
+            journal_file.write(text)
+            journal_size = journal_file.tell()
+            if Database.durability != "none":
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+        if new_journal and Database.durability == "directory":
+            Database.__fsync_directory(os.path.dirname(database_path))
+        if start is not None:
+            Database.__record(name, "write", time.perf_counter() - start, len(text))
+        Database.__notify(name, {record[1] for record in records})
+        if before is not None:  # The index is saved again when the journal is compacted
+            changed = {record[1] for record in records}
+            if any(record[0] == "a" for record in records):
+                # The whole list is needed, the records that were just added are replayed by the read
+                latest = Database.__read(name)
+            else:
+                latest = {}
+                for record in records:
+                    if record[0] == "s":
+                        latest[record[1]] = record[2]
+                    else:
+                        latest.pop(record[1], None)
+            Database.__update_indexes(name, before, latest, changed, save=False)
+        if journal_size > Database.journal_compact_size or \
+                journal_size > Database.journal_compact_ratio * os.path.getsize(database_path):
+            Database.__write(name, Database.__load(name), ())
+
+    @staticmethod
+    def __signature(name: str):
+        """ Returns what is used to check if a cached document is still the same as the files on disk. """
+        if name in Database.__shards:
+            return tuple(Database.__signature(shard) for shard in Database.__shard_names(name))
+        stat = os.stat(os.path.join(Database.my_path, name + ".json"))
+        try:
+            journal_size = os.path.getsize(os.path.join(Database.my_path, name + ".wal"))
+        except FileNotFoundError:
+            journal_size = None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino, journal_size
+
+    @staticmethod
+    def __cache_get(name: str, signature):
+        """ Returns a fresh copy of the cached document if the cache entry still matches signature otherwise None. """
+        with Database.__cache_lock:
+            entry = Database.__cache.get(name)
+            if entry is None or entry[0] != signature:
+                Database.__cache_misses += 1
+                return None
+            Database.__cache.move_to_end(name)
+            Database.__cache_hits += 1
+            _, payload, pickled = entry
+
+        if pickled:
+            return pickle.loads(payload)
+        # The entry was filled by a write with the serialized document, parse it once and keep the faster pickle
+        database = Database.__decode(payload)
+        Database.__cache_put(name, signature, pickle.dumps(database, pickle.HIGHEST_PROTOCOL), True)
         return database
 
+    @staticmethod
+    def __cache_put(name: str, signature, payload: bytes, pickled: bool):
+        """ Stores payload (pickled or serialized document) for name and evicts the least recently used documents
+            until the cache fits in cache_size again.
+        """
+        with Database.__cache_lock:
+            old = Database.__cache.pop(name, None)
+            if old is not None:
+                Database.__cache_used -= len(old[1])
+            if len(payload) > Database.cache_size:
+                return
+            Database.__cache[name] = (signature, payload, pickled)
+            Database.__cache_used += len(payload)
+            while Database.__cache_used > Database.cache_size:
+                _, (_, evicted, _) = Database.__cache.popitem(last=False)
+                Database.__cache_used -= len(evicted)
+
+    @staticmethod
+    def cache_info():
+        """ Gives the hits, misses and memory use of the document cache. """
+        with Database.__cache_lock:
+            return {
+                "hits": Database.__cache_hits,
+                "misses": Database.__cache_misses,
+                "documents": len(Database.__cache),
+                "used": Database.__cache_used,
+                "size": Database.cache_size
+            }
+
+    @staticmethod
+    def clear_cache():
+        """ Empties the document cache and resets the hit and miss counters. """
+        with Database.__cache_lock:
+            Database.__cache.clear()
+            Database.__cache_used = 0
+            Database.__cache_hits = 0
+            Database.__cache_misses = 0
+
+    @staticmethod
+    def snapshot(name: str) -> MappingProxyType:
+        """ Returns a read only version of <name>.json that is shared by every thread that asks for it, so a big
+            document is only in memory once. Dicts are MappingProxyTypes and lists are tuples. It is only built again
+            when the document changed. Use read for a copy you can change.
+        """
+        signature = Database.__signature(name)
+        entry = Database.__snapshots.get(name)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        with Database.__snapshot_locks.setdefault(name, threading.Lock()):
+            entry = Database.__snapshots.get(name)
+            if entry is not None and entry[0] == signature:  # Another thread built it while this one waited
+                return entry[1]
+            # A write after the signature was taken can be in this snapshot, then the next call just builds it again
+            frozen = _freeze(Database.read(name), {})
+            Database.__snapshots[name] = (signature, frozen)
+            return frozen
+
+    @staticmethod
+    def __notify(name: str, keys):
+        """ Tells the watchers of name that keys changed, None if it is not known which keys changed. """
+        if not Database.__watchers:
+            return
+        with Database.__watch_condition:
+            for watcher in Database.__watchers.get(name, ()):
+                if keys is None:
+                    watcher.everything = True
+                else:
+                    watcher.pending.update(keys)
+            Database.__watch_condition.notify_all()
+
+    @staticmethod
+    def watch(name: str, keys: list = None, timeout: float = None):
+        """ Yields (key, old, new) for every top level key of <name>.json that changes, old is None for a new key
+            and new is None for a deleted key. With keys only those keys are watched. Changes made in this process
+            are seen right away, changes by other processes within watch_interval seconds. Stops when there was no
+            change for timeout seconds if timeout is given. Break out of the loop to stop watching.
+        """
+        watcher = _Watcher(None if keys is None else set(keys))
+        documents = Database.__shard_names(name) if name in Database.__shards else [name]
+        with Database.__watch_condition:
+            for document in documents:
+                Database.__watchers.setdefault(document, []).append(watcher)
+        try:
+            signature = Database.__signature(name)
+            current = Database.read(name)
+            last_change = time.monotonic()
+            while True:
+                with Database.__watch_condition:
+                    Database.__watch_condition.wait_for(lambda: watcher.everything or watcher.pending,
+                                                        Database.watch_interval)
+                    everything, pending = watcher.everything, watcher.pending
+                    watcher.everything, watcher.pending = False, set()
+                if watcher.keys is not None:
+                    pending &= watcher.keys
+                if not everything and not pending:
+                    if Database.__signature(name) == signature:
+                        if timeout is not None and time.monotonic() - last_change > timeout:
+                            return
+                        continue
+                    everything = True  # Changed by another process or by a change to keys that are not watched
+                signature = Database.__signature(name)  # Before the read so a change during the read is seen later
+                new = Database.read(name)
+                for key in list(current) + [key for key in new if key not in current]:
+                    if not everything and key not in pending or watcher.keys is not None and key not in watcher.keys:
+                        continue
+                    if (key in current) != (key in new) or current.get(key) != new.get(key):
+                        last_change = time.monotonic()
+                        yield key, current.get(key), new.get(key)
+                if everything:
+                    current = new
+                else:  # new can already have other changes, those are compared when their notification is handled
+                    for key in pending:
+                        if key in new:
+                            current[key] = new[key]
+                        else:
+                            current.pop(key, None)
+        finally:
+            with Database.__watch_condition:
+                for document in documents:
+                    Database.__watchers[document].remove(watcher)
+                    if not Database.__watchers[document]:
+                        del Database.__watchers[document]
+
+    @staticmethod
+    def __record(name: str, metric: str, seconds: float, size: int = None):
+        """ Adds a measurement to the stats of name and calls the hooks. With size also adds <metric>_bytes. """
+        measurements = [(metric, seconds, _TIME_BUCKETS)]
+        if size is not None:
+            measurements.append((metric + "_bytes", size, _SIZE_BUCKETS))
+        with Database.__stats_lock:
+            document = Database.__stats.setdefault(name, {})
+            for metric_name, value, buckets in measurements:
+                stat = document.get(metric_name)
+                if stat is None:
+                    stat = document[metric_name] = [0, 0, 0, [0] * (len(buckets) + 1)]
+                stat[0] += 1
+                stat[1] += value
+                stat[2] = max(stat[2], value)
+                stat[3][bisect.bisect_left(buckets, value)] += 1
+        for hook in Database.hooks:
+            for metric_name, value, _ in measurements:
+                hook(name, metric_name, value)
+
+    @staticmethod
+    def stats(name: str = None) -> dict:
+        """ Gives the measurements of instrumentation as name -> metric -> count, total, mean, max and a histogram.
+            The metrics are lock_wait, lock_hold, read, parse, serialize and write in seconds and read_bytes and
+            write_bytes. Give a name to only get the stats of that document.
+        """
+        with Database.__stats_lock:
+            documents = {document: {metric: (list(stat[:3]), list(stat[3])) for metric, stat in metrics.items()}
+                         for document, metrics in Database.__stats.items() if name is None or document == name}
+        result = {}
+        for document, metrics in documents.items():
+            result[document] = {}
+            for metric, ((count, total, maximum), histogram) in metrics.items():
+                buckets = _SIZE_BUCKETS if metric.endswith("_bytes") else _TIME_BUCKETS
+                labels = [f"<={bucket}" for bucket in buckets] + [f">{buckets[-1]}"]
+                result[document][metric] = {"count": count, "total": total, "mean": total / count, "max": maximum,
+                                            "histogram": dict(zip(labels, histogram))}
+        return result if name is None else result.get(name, {})
+
+    @staticmethod
+    def clear_stats():
+        """ Forgets all measurements of instrumentation. """
+        with Database.__stats_lock:
+            Database.__stats.clear()
+
     def reads(self):
         """ Will read <self.name>.json without a lock. """
         return Database.__read(self.name)
@@ -111,140 +1984,819 @@ class Database(UserDict):
         """ Will write data to the <name>.json with a lock. Do not run in other lock that will cause a deadlock! 
             ALso do not run this in general use the context manager.
         """
+        data = Database.__validate(name, data)
         with Database.get_lock(name):
             return Database.__write(name, data)
 
     @staticmethod
-    def __write(name: str, data: dict):
-        """ Will write data to <name>.json without a lock. Maybe rename this to _write_unsafe? """
-        database_path = os.path.join(os.path.dirname(__file__), name + ".json")
-        with open(database_path, "w+") as file:
-            json.dump(data, file, indent=4, sort_keys=True)
+    def __schema(name: str):
+        """ Returns the compiled schema of <name> or None if it has no schema. """
+        schema = Database.schemas.get(name)
+        if schema is None:
+            return None
+        compiled = Database.__schemas.get(name)
+        if compiled is None or compiled.schema is not schema:
+            compiled = Database.__schemas[name] = _Schema(schema)
+        return compiled
+
+    @staticmethod
+    def __validate(name: str, data, changed=None):
+        """ Checks data against the schema of <name> and returns it as json. Only the keys in changed are checked
+            if changed is not None. Raises a TypeError if data does not match the schema.
+        """
+        schema = Database.__schema(name)
+        if schema is None:
+            return data
+        start = time.perf_counter() if Database.instrumentation else None
+        try:
+            data = schema.validate(data, changed)
+        except TypeError as error:
+            raise TypeError(f"{name}{error}") from None
+        if start is not None:
+            Database.__record(name, "validate", time.perf_counter() - start)
+        return data
+
+    @staticmethod
+    def __validate_record(name: str, record: list) -> list:
+        schema = Database.__schema(name)
+        if schema is None:
+            return record
+        try:
+            return schema.validate_record(record)
+        except TypeError as error:
+            raise TypeError(f"{name}{error}") from None
+
+    @staticmethod
+    def read_typed(name: str):
+        """ Will read <name>.json and decode it with its schema, so the records are dataclasses instead of dicts. """
+        schema = Database.__schema(name)
+        assert schema is not None, "You are trying to read a document without a schema as typed."
+        return schema.decode(Database.read(name))
+
+    @staticmethod
+    def __write(name: str, data: dict, changed=None, raw: bytes = None):
+        """ Will write data to <name>.json without a lock. Maybe rename this to _write_unsafe?
+            changed can be the keys that changed since the last write, then only those are re-indexed.
+            For a sharded document only the shards with changed keys are written. raw can be data already serialized.
+        """
+        if name in Database.__shards:
+            for shard, shard_data, _ in Database.__split(name, data, changed):
+                Database.__write(shard, shard_data)
+            return
+        database_path = os.path.join(Database.my_path, name + ".json")
+        if raw is None:
+            raw = Database.__encode(name, data)  # Serialize first so a TypeError does not touch the file
+        before = Database.__signature(name) if name in Database.__indexes else None
+        start = time.perf_counter() if Database.instrumentation else None
+        Database.__replace(database_path, raw)
+        if start is not None:
+            Database.__record(name, "write", time.perf_counter() - start, len(raw))
+        Database.__written(name, raw, data, changed, before)
+
+    @staticmethod
+    def __split(name: str, data: dict, changed=None) -> list:
+        """ Returns (document, data, changed) for the files that have to be written to write data to name.
+            For a sharded document these are the shards with changed keys.
+        """
+        if name not in Database.__shards:
+            return [(name, data, changed)]
+        parts = {shard: {} for shard in Database.__shard_names(name)}
+        for key, value in data.items():
+            parts[Database.__route(name, key)][key] = value
+        shards = parts if changed is None else {Database.__route(name, key) for key in changed}
+        return [(shard, parts[shard], None) for shard in shards]
+
+    @staticmethod
+    def __written(name: str, raw: bytes, data: dict, changed, before):
+        """ Updates the journal, cache, indexes and watchers after raw was renamed over <name>.json. """
+        try:  # Everything in the journal is in <name>.json now
+            os.remove(os.path.join(Database.my_path, name + ".wal"))
+        except FileNotFoundError:
+            pass
+        if Database.cache_size > 0:
+            Database.__cache_put(name, Database.__signature(name), raw, False)
+        if before is not None:
+            Database.__update_indexes(name, before, data, changed)
+        Database.__notify(name, changed)
+
+    @staticmethod
+    def __stage(path: str, raw: bytes) -> str:
+        """ Writes raw to a temporary file next to path and returns the path of the temporary file.
+            The temporary file gets the permissions of path, if it is there, so the rename does not change them.
+        """
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_path, "wb") as file:
+                file.write(raw)
+                if Database.durability != "none":
+                    file.flush()
+                    os.fsync(file.fileno())
+            try:
+                shutil.copymode(path, temporary_path)
+            except FileNotFoundError:  # A new file
+                pass
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        return temporary_path
+
+    @staticmethod
+    def __replace(path: str, raw: bytes):
+        """ Writes raw to a temporary file next to path and renames it over path so path is never half written.
+            If path is a symlink the file it points to is replaced, so the symlink stays.
+        """
+        path = os.path.realpath(path)
+        temporary_path = Database.__stage(path, raw)
+        try:
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        if Database.durability == "directory":
+            Database.__fsync_directory(os.path.dirname(path))
+
+    @staticmethod
+    @contextmanager
+    def transaction(names: list):
+        """ Use in a with statement to change multiple documents at once. Gives a dict with the data of every name.
+            The locks are taken in sorted order so transactions can not deadlock with each other. When the with
+            ends without an error all the changed documents are written, otherwise none of them are. Do not use
+            the other methods on these documents inside the with, that will cause a deadlock.
+        """
+        for name in names:
+            assert name in Database.locks or name in Database.__shards, \
+                "You are trying to acces a database that does not exist."
+        documents = {document for name in names
+                     for document in (Database.__shard_names(name) if name in Database.__shards else [name])}
+        locks = []
+        try:
+            for document in sorted(documents):
+                lock = Database.get_lock(document)
+                lock.acquire()
+                locks.append(lock)
+            changes = {name: _Changes() for name in names}
+            data = {name: _TrackedDict(Database.__read(name), changes[name]) for name in changes}
+            try:
+                yield data
+            finally:
+                for change in changes.values():
+                    change.active = False
+            writes = {}
+            for name, value in data.items():
+                if not isinstance(value, _TrackedDict):  # Replaced completely
+                    writes[name] = (Database.__validate(name, value), None)
+                elif changes[name]:
+                    changed = None if changes[name].everything else changes[name].keys
+                    writes[name] = (Database.__validate(name, value, changed), changed)
+            Database.__commit(writes)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @staticmethod
+    def __commit(writes: dict):
+        """ Writes name -> (data, changed) for all names or for none of them without locks.
+            First every document is serialized and written to a temporary file. Then a manifest with the renames
+            is written and the renames are done. If the process stops during the renames _roll_forward finishes them.
+        """
+        directory = Database.my_path
+        staged = []
+        for name, (data, changed) in writes.items():
+            for document, document_data, document_changed in Database.__split(name, data, changed):
+                raw = Database.__encode(document, document_data)  # A TypeError here has not touched anything
+                before = Database.__signature(document) if document in Database.__indexes else None
+                # Through a symlink to the real file like in __replace
+                target = os.path.realpath(os.path.join(directory, document + ".json"))
+                staged.append([document, raw, document_data, document_changed, before, None, target])
+        if not staged:
+            return
+        try:
+            for entry in staged:
+                start = time.perf_counter() if Database.instrumentation else None
+                entry[5] = Database.__stage(entry[6], entry[1])
+                if start is not None:
+                    Database.__record(entry[0], "write", time.perf_counter() - start, len(entry[1]))
+        except BaseException:
+            for entry in staged:
+                if entry[5] is not None:
+                    os.remove(entry[5])
+            raise
+        manifest_path = os.path.join(directory, _TRANSACTIONS, f"{os.getpid()}.{threading.get_ident()}.transaction")
+        renames = [(os.path.relpath(entry[5], directory), os.path.relpath(entry[6], directory)) for entry in staged]
+        if len(renames) > 1:
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+            Database.__replace(manifest_path, json.dumps(renames).encode())
+        for temporary, target in renames:
+            os.replace(os.path.join(directory, temporary), os.path.join(directory, target))
+        if Database.durability == "directory":
+            for folder in {os.path.dirname(entry[6]) for entry in staged}:
+                Database.__fsync_directory(folder)
+        if len(renames) > 1:
+            os.remove(manifest_path)
+        for document, raw, document_data, document_changed, before, _, _ in staged:
+            Database.__written(document, raw, document_data, document_changed, before)
+
+    @staticmethod
+    def __fsync_directory(path: str):
+        """ Makes renames and new files in the directory at path durable. Not all platforms can open directories. """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
 
     def writes(self, data: dict = None):
         """ Will write data to <self.name>.json without a lock.
             If data is None it will write self.data
         """
         if data is None:
-            self.__write(self.name, self.data)
-        else:
-            self.__write(self.name, data)
+            data = self.data
+        self.__write(self.name, Database.__validate(self.name, data))
+
+    @staticmethod
+    def create_index(name: str, field: str, kind: str = "hash"):
+        """ Will index field in all the records in <name>.json so query can find records without a full scan.
+            field can point into nested records with dots, like "profile.age". kind is "hash" for == and in
+            lookups or "sorted" to also support <, <=, > and >=. The index is kept up to date by all writes and is
+            saved in <name>.index.
+        """
+        with Database.get_lock(name):
+            with Database.__index_lock:
+                index = Database.__load_index(name)
+                if index is None:
+                    index = _Index(os.path.join(Database.my_path, name + ".index"))
+                if index.fields.get(field) == kind and index.signature == Database.__signature(name):
+                    return
+                signature = Database.__signature(name)
+                document = Database.__read(name)
+                if index.signature != signature:
+                    index.rebuild(document)
+                index.add_field(field, kind, document)
+                index.signature = signature
+                Database.__indexes[name] = index
+                Database.__replace(index.path, index.dumps())
+
+    @staticmethod
+    def drop_index(name: str, field: str):
+        """ Will remove the index on field of <name>.json. """
+        with Database.get_lock(name):
+            with Database.__index_lock:
+                index = Database.__load_index(name)
+                if index is None or field not in index.fields:
+                    return
+                index.remove_field(field)
+                if index.fields:
+                    Database.__replace(index.path, index.dumps())
+                else:
+                    del Database.__indexes[name]
+                    os.remove(index.path)
+
+    @staticmethod
+    def __load_index(name: str):
+        """ Returns the _Index of <name> or None if it has no indexes. Call with __index_lock. """
+        index = Database.__indexes.get(name)
+        if index is None:
+            index_path = os.path.join(Database.my_path, name + ".index")
+            try:
+                with open(index_path, "rb") as index_file:
+                    index = Database.__indexes[name] = _Index.loads(index_path, index_file.read())
+            except FileNotFoundError:
+                return None
+        return index
+
+    @staticmethod
+    def __update_indexes(name: str, before, records: dict, changed, save: bool = True):
+        """ Brings the indexes of <name> up to date after a write without a lock.
+            before is the signature of the document before the write. changed None means everything changed.
+        """
+        with Database.__index_lock:
+            index = Database.__indexes.get(name)
+            if index is None:
+                return
+            if changed is None:
+                index.rebuild(records)
+            elif index.signature != before:  # Someone else wrote the document, these changes are not enough
+                index.rebuild(Database.__read(name))
+            else:
+                index.update(records, changed)
+            index.signature = Database.__signature(name)
+            if save:
+                Database.__replace(index.path, index.dumps())
+
+    @staticmethod
+    def query(name: str, where=None, fields: list = None) -> dict:
+        """ Will return the records in <name>.json that match where, as a dict with the same keys as the document.
+
+            where is a dict from field to a value the field has to be equal to, or to a condition like (">=", 18).
+            The operators are ==, !=, <, <=, >, >= and in. Fields can point into nested records with dots.
+            where can also be a function that gets a record and returns if it matches, that always scans.
+            Conditions on indexed fields are answered by the index, see create_index.
+            If fields is given only those fields are returned for every record.
+        """
+        with Database.get_lock(name).shared():
+            return Database.__query(name, where, fields)
+
+    def queries(self, where=None, fields: list = None) -> dict:
+        """ Will return the records in <self.name>.json that match where. See query. """
+        with self.lock.shared():
+            return Database.__query(self.name, where, fields)
+
+    @staticmethod
+    def __query(name: str, where, fields):
+        """ Runs a query without a lock. """
+        conditions = []
+        if isinstance(where, dict):
+            for field, condition in where.items():
+                op, operand = condition if isinstance(condition, tuple) else ("==", condition)
+                assert op in _OPERATORS or op == "in", f"Unknown operator {op!r}."
+                conditions.append((field, op, operand))
+
+        candidates = None
+        remaining = []
+        with Database.__index_lock:
+            index = Database.__load_index(name)
+            if index is not None:
+                signature = Database.__signature(name)
+                if index.signature != signature:  # Written by a process that did not keep the index up to date
+                    index.rebuild(Database.__read(name))
+                    index.signature = signature
+            for field, op, operand in conditions:
+                keys = index.lookup(field, op, operand) if index is not None and field in index.fields else None
+                if keys is None:
+                    remaining.append((field.split("."), op, operand))
+                else:
+                    candidates = keys if candidates is None else candidates & keys
+
+            # Everything that was asked is in the index so the document does not have to be read
+            if candidates is not None and not remaining and not callable(where) and fields is not None and \
+                    all(field in index.fields for field in fields):
+                return {key: {field: index.values[field][key] for field in fields if key in index.values[field]}
+                        for key in sorted(candidates)}
+
+        document = Database.__read(name)
+        result = {}
+        for key, record in document.items():
+            if candidates is not None and key not in candidates:
+                continue
+            if not all(_matches(_field(record, parts), op, operand) for parts, op, operand in remaining):
+                continue
+            if callable(where) and not where(record):
+                continue
+            if fields is not None:
+                record = {field: value for field in fields
+                          for value in [_field(record, field.split("."))] if value is not _MISSING}
+            result[key] = record
+        return result
 
     @staticmethod
-    def create(name: str, data: dict = None, replace: bool = False):
-        """ Will create a new file named <name>.json with data inside and will add file to lock. """
+    def create(name: str, data: dict = None, replace: bool = False, shards: int = 0, schema=None):
+        """ Will create a new file named <name>.json with data inside and will add file to lock.
+            With shards the document is split over that many files, each with its own lock. Then writes to a key
+            only rewrite and lock the shard the key is in.
+            With schema, a dataclass or Dict[str, X], every write to the document is checked against it, also when
+            the document already exists. See read_typed. Schemas are not saved, give it again after a restart.
+        """
+        assert _is_name(name), "The name of a document can not be a path."
         if data is None:
             data = dict()
-        if name not in Database.locks:
-            Database.locks[name] = Lock()
-            database_path = os.path.join(os.path.dirname(__file__), name + ".json")
-            open(database_path, "w+").close()
-            Database.write(name, data)
-            return data
-        elif name in Database.locks and replace:  # File already there
-            database_path = os.path.join(os.path.dirname(__file__), name + ".json")
-            open(database_path, "w+").close()
-            Database.write(name, data)
-            return data
+        if schema is not None:
+            Database.schemas[name] = schema
+        if shards or name in Database.__shards:
+            assert name not in Database.locks, "A document can not be sharded after it was created."
+            assert name not in Database.__shards or Database.__shards[name] == (shards or Database.__shards[name]), \
+                "A sharded document can not change its amount of shards."
+            if name in Database.__shards and not replace:
+                return None
+            data = Database.__validate(name, data)  # Before any file is made
+            for shard in range(shards or Database.__shards[name]):
+                Database.create(f"{name}.shard{shard}", {}, replace=True)
+            manifest_path = os.path.join(Database.my_path, name + ".shards")
+            Database.__replace(manifest_path, json.dumps({"shards": shards or Database.__shards[name]}).encode())
+            Database.__shards[name] = shards or Database.__shards[name]
+        elif name not in Database.locks:
+            data = Database.__validate(name, data)  # Before the document is known
+            Database.locks.setdefault(name, RWLock())
+        elif replace:  # File already there
+            data = Database.__validate(name, data)
+        else:
+            return None
+        with Database.get_lock(name):
+            Database.__write(name, data)
+        return data
 
     @staticmethod
     def add(name: str, key: str, data: dict):
         """ Will try to add the data under the identifier to the specified file. If the data is already in this file
         it will override this data. This is a (probably faster) shorthand for combining get and set. """
-        with Database.get_lock(name):
-            database = Database.__read(name)
-            database[key] = data
-            Database.__write(name, database)
+        Database.__update(name, ["s", key, data])
 
     def adds(self, key, data: dict):
         """ Will try to add the data under the identifier to the specified file. If the data is already in this file
         it will override this data. This is a shorthand for combining get and set. """
-        with self.lock:
-            database = self.reads()
-            database[key] = data
-            self.writes(database)
+        Database.__update(self.name, ["s", key, data])
 
     @staticmethod
     def append(name, data):
         """ Will append database to a list named <name> in a file named <name>.json. """
-        with Database.get_lock(name):
-            database = Database.__read(name)
-            database[name].append(data)
-            Database.__write(name, database)
+        Database.__update(name, ["a", name, data])
 
     def appends(self, data):
         """ Will append database to a list named <self.name> in a file named <self.name>.json. """
-        with self.lock:
-            database = self.reads()
-            database[self.name].append(data)
-            self.writes(database)
+        Database.__update(self.name, ["a", self.name, data])
+
+    @staticmethod
+    def delete(name: str, key: str):
+        """ Will remove key from <name>.json if it is in there. """
+        Database.__update(name, ["d", key])
+
+    def deletes(self, key: str):
+        """ Will remove key from <self.name>.json if it is in there. """
+        Database.__update(self.name, ["d", key])
+
+    @staticmethod
+    def add_many(name: str, data: dict):
+        """ Will add every key and value in data to <name>.json with one read and one write. """
+        Database.__update_many(name, [["s", key, value] for key, value in data.items()])
+
+    @staticmethod
+    def append_many(name: str, items):
+        """ Will append every item in items to the list named <name> in <name>.json with one read and one write. """
+        Database.__update_many(name, [["a", name, item] for item in items])
+
+    @staticmethod
+    def delete_many(name: str, keys):
+        """ Will remove every key in keys from <name>.json with one read and one write. """
+        Database.__update_many(name, [["d", key] for key in keys])
+
+    @staticmethod
+    def __update_many(name: str, records: list):
+        """ Applies the records to <name>.json with one lock, read and write per file, so per shard if it is sharded. """
+        shards = {}
+        for record in records:
+            shards.setdefault(Database.__route(name, record[1]), []).append(Database.__validate_record(name, record))
+        for shard in sorted(shards):
+            with Database.get_lock(shard):
+                Database.__apply(shard, shards[shard])
+
+    @staticmethod
+    def read_many(names: list, executor=None) -> dict:
+        """ Reads all the documents in names at the same time and returns name -> data.
+            executor can be any concurrent.futures executor, by default a thread for every cpu is used. Parsing only
+            really happens at the same time with a ProcessPoolExecutor, the documents are pickled back from it.
+        """
+        names = list(names)
+        if executor is None:
+            with ThreadPoolExecutor(max(1, min(len(names), os.cpu_count() or 1))) as executor:
+                return dict(zip(names, executor.map(Database.read, names)))
+        return dict(zip(names, executor.map(Database.read, names)))
+
+    @staticmethod
+    def __update(name: str, record: list):
+        """ Applies an add ("s"), append ("a") or delete ("d") record to <name>.json, or its shard, with its lock.
+            With group_commit on the record waits group_commit_window seconds for records from other threads and
+            they are all written at once by the first one.
+        """
+        record = Database.__validate_record(name, record)  # Only the value in the record is checked
+        name = Database.__route(name, record[1])
+        if not Database.group_commit:
+            with Database.get_lock(name):
+                return Database.__apply(name, [record])
+        with Database.__group_lock:
+            group = Database.__groups.get(name)
+            leader = group is None
+            if leader:
+                group = Database.__groups[name] = _Group()
+            number = len(group.records)
+            group.records.append(record)
+        if leader:
+            try:
+                time.sleep(Database.group_commit_window)
+            finally:
+                with Database.__group_lock:
+                    del Database.__groups[name]  # Records that come in now start a new group
+            try:
+                with Database.get_lock(name):
+                    try:
+                        write = Database.__prepare(name, group.records)
+                    except Exception:  # Nothing was written, so one bad record does not fail the others
+                        for index, single in enumerate(group.records):
+                            try:
+                                Database.__apply(name, [single])
+                            except Exception as error:
+                                group.errors[index] = error
+                    else:
+                        write()  # Part of it can be on disk when this fails, so the error is for all the records
+            except BaseException as error:
+                group.errors.update(dict.fromkeys(range(len(group.records)), error))
+            finally:
+                group.done.set()
+        else:
+            group.done.wait()
+        if number in group.errors:
+            raise group.errors[number]
+
+    @staticmethod
+    def __apply(name: str, records: list):
+        """ Will apply the records to <name>.json without a lock and write it once.
+            With the journal on they are added to <name>.wal and a missing list is created because the document
+            is not read. For the same reason an append to a value that is not a list does not raise, it is skipped.
+        """
+        Database.__prepare(name, records)()
+
+    @staticmethod
+    def __prepare(name: str, records: list):
+        """ Applies the records to <name>.json in memory and serializes the result without a lock. Everything that
+            can go wrong before something is written happens here. Returns the function that writes it.
+        """
+        if Database.journal:
+            text = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+            return lambda: Database.__journal(name, records, text)
+        database = Database.__read(name)
+        for record in records:
+            if record[0] == "s":
+                database[record[1]] = record[2]
+            elif record[0] == "a":
+                database[record[1]].append(record[2])
+            else:
+                database.pop(record[1], None)
+        raw = Database.__encode(name, database)
+        return lambda: Database.__write(name, database, {record[1] for record in records}, raw)
 
     @staticmethod
     def reset_all(default_data: dict):
         """ Will reset all databases. The reset state should be registered manually for special cases. """
-        for name in Database.locks.keys():
+        for name in Database.__documents():
             Database.write(name, default_data)
 
+    @staticmethod
+    def __documents() -> list:
+        """ Returns the names of all documents with sharded documents as one document instead of their shards. """
+        Database.locks.discover()
+        Database.__shards.discover()
+        shards = {shard for name in Database.__shards for shard in Database.__shard_names(name)}
+        return [name for name in list(Database.locks) if name not in shards] + list(Database.__shards)
+
     @staticmethod
     def translate(name, key):
         """ Will translate a name to the corresponding ID """
-        return Database.read(name)[key]
+        return Database.read(Database.__route(name, key))[key]
 
     def translates(self, key):
         """ Will translate a name to the corresponding ID """
-        return self.reads()[key]
+        return Database.__read(Database.__route(self.name, key))[key]
 
     def __enter__(self):
         self.__in_with = True
         self.clear()
-        self.lock.acquire()
-        self.data = self.reads()
-        self.backup_data = copy.deepcopy(self.data)  # Make a deep copy to preserve the backup and also lists inside the backup
+        self.__held = self.lock
+        if self.__readonly:
+            self.__held.acquire_shared()
+        else:
+            self.__held.acquire()
+        try:
+            if self.__readonly:
+                self.data = self.reads()
+            else:
+                self.__changes = _Changes()
+                # Nothing needs to be copied for a rollback. The file is only touched once all the data serialized.
+                self.data = _TrackedDict(self.reads(), self.__changes)
+        except BaseException:
+            self.__release()
+            raise
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.__readonly:  # Changes made in a readonly with statement are not written
+            return self.__release()
         try:
-            if exc_type is None:  # There was an error in context attempt rollback
-                try:  # Try to write new data
-                    self.writes()
-                except TypeError as e:  # This can happen if data is not json serializable, Attempt rollback and then raise the error to notify
-                    self.__write(self.name, self.backup_data)
-                    raise e
+            changes, self.__changes = self.__changes, None
+            changes.active = False  # Also keeps the json encoder from wrapping everything it walks over
+            # Nothing is written when there was an error in the with. A TypeError from data that is not json
+            # serializable or does not match the schema happens before the file is opened so the file stays as it was.
+            if exc_type is None and not isinstance(self.data, _TrackedDict):
+                self.writes()
+            elif exc_type is None and changes:
+                changed = None if changes.everything else changes.keys
+                # Only the changed keys are checked against the schema
+                self.__write(self.name, Database.__validate(self.name, self.data, changed), changed)
         finally:
-            self.__in_with = False
-            self.lock.release()
+            self.__release()
+
+    def __release(self):
+        """ Releases the lock that __enter__ acquired. """
+        self.__in_with = False
+        lock, self.__held = self.__held, None
+        if self.__readonly:
+            lock.release_shared()
+        else:
+            lock.release()
 
     @staticmethod
-    def create_backup(document_names: list[str] = "all_of_them"):
+    def create_backup(document_names: list[str] = "all_of_them", keep: int = None, max_age: float = None):
         """
         Makes backups in a backup folder with the date
+        Documents are only ever replaced by renaming a new file over them, so a backup is a hard link to the file as
+        it is now. The lock is only held while the link is made and documents that did not change since the last
+        backup are the same file as in that backup. When the backup folder is on another file system the files are
+        copied after the lock is released, or linked to the last backup if they are the same as in there.
         :param document_names:
+        :param keep: Remove the oldest backups until only this many are left.
+        :param max_age: Remove the backups that are older than this many seconds.
         """
 
         if document_names == "all_of_them":
-            document_names = Database.locks.keys()
+            document_names = Database.__documents()
 
         if len(document_names) <= 0:
             return
 
-        locks = Database.locks
         timestring = time.strftime("%Y%m%d-%H%M%S")
 
         if not os.path.exists(Database.backup_folder_path):
             os.mkdir(Database.backup_folder_path)
 
+        previous = Database.list_backups()
+        previous_path = os.path.join(Database.backup_folder_path, previous[-1]) if previous else None
         backup_path = os.path.join(Database.backup_folder_path, timestring)
+        number = 0
+        while os.path.exists(backup_path):  # More than one backup in a second
+            number += 1
+            backup_path = os.path.join(Database.backup_folder_path, f"{timestring}-{number}")
 
         os.mkdir(backup_path)
 
         for document_name in document_names:
-            filename = document_name
-            if not filename.endswith(".json"):
-                filename += ".json"
-            src = os.path.join(Database.my_path, filename)
-            dst = os.path.join(backup_path, filename)
-            with locks[document_name]:
-                shutil.copy2(src, dst)
+            if document_name.endswith(".json"):
+                document_name = document_name[:-5]
+            if document_name in Database.__shards:
+                shutil.copy2(os.path.join(Database.my_path, document_name + ".shards"), backup_path)
+                documents = Database.__shard_names(document_name)
+            else:
+                documents = [document_name]
+            with Database.get_lock(document_name).shared():
+                copies = [Database.__snapshot(document, backup_path) for document in documents]
+            for document, file in zip(documents, copies):
+                if file is not None:
+                    with file:
+                        Database.__copy_snapshot(file, document + ".json", backup_path, previous_path)
+
+        Database.remove_backups(keep, max_age)
+
+    @staticmethod
+    def __snapshot(name: str, backup_path: str):
+        """ Links <name>.json into backup_path and copies the journal records that belong to it. Call with a lock.
+            Returns the opened file if it could not be linked or has to be compressed so it can be copied after the
+            lock is released.
+        """
+        source = os.path.join(Database.my_path, name + ".json")
+        file = open(source, "rb")
+        try:
+            stat = os.fstat(file.fileno())
+            records = Database.__journal_records(name, stat)
+            if records:
+                with open(os.path.join(backup_path, name + ".wal"), "w") as journal_file:
+                    journal_file.write(json.dumps(["h", stat.st_mtime_ns, stat.st_size, stat.st_ino]) + "\n")
+                    journal_file.writelines(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+            if Database.backup_compression is not None and _compression_of(file.read(8)) is None:
+                file.seek(0)
+                return file
+            os.link(source, os.path.join(backup_path, name + ".json"))
+        except OSError:  # Another file system or a file system without hard links
+            return file
+        except BaseException:
+            file.close()
+            raise
+        file.close()
+        return None
+
+    @staticmethod
+    def __copy_snapshot(file, filename: str, backup_path: str, previous_path: str = None):
+        """ Copies the opened document to backup_path, compressed with backup_compression if it is not compressed yet.
+            If it is the same as in the previous backup it is linked to that one instead.
+        """
+        destination = os.path.join(backup_path, filename)
+        stat = os.fstat(file.fileno())
+        compression = None if _compression_of(file.read(8)) else Database.backup_compression
+        file.seek(0)
+        if compression is not None:
+            with open(destination, "wb") as backup_file, Database.__compressor(compression, backup_file) as compressor:
+                shutil.copyfileobj(file, compressor)
+            previous = None if previous_path is None else os.path.join(previous_path, filename)
+            # The same document always compresses to the same bytes so this finds documents that did not change
+            if previous is not None and os.path.exists(previous) and \
+                    os.path.getsize(previous) == os.path.getsize(destination):
+                with open(previous, "rb") as previous_file, open(destination, "rb") as backup_file:
+                    same = Database.__digest(previous_file) == Database.__digest(backup_file)
+                if same:
+                    os.remove(destination)
+                    os.link(previous, destination)
+                    return
+            os.utime(destination, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            return
+        if previous_path is not None:
+            previous = os.path.join(previous_path, filename)
+            if os.path.exists(previous) and os.path.getsize(previous) == stat.st_size:
+                with open(previous, "rb") as previous_file:
+                    if Database.__digest(previous_file) == Database.__digest(file):
+                        os.link(previous, destination)
+                        return
+                file.seek(0)
+        with open(destination, "wb") as backup_file:
+            shutil.copyfileobj(file, backup_file)
+        os.utime(destination, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    @staticmethod
+    def __digest(file) -> bytes:
+        digest = hashlib.sha256()
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+        return digest.digest()
+
+    @staticmethod
+    def list_backups() -> list:
+        """ Returns the names of the backup folders from old to new. """
+        if not os.path.exists(Database.backup_folder_path):
+            return []
+        backups = [backup for backup in os.listdir(Database.backup_folder_path) if _BACKUP.fullmatch(backup)]
+        return sorted(backups, key=lambda backup: (backup[:15], int(backup[16:] or 0)))
+
+    @staticmethod
+    def remove_backups(keep: int = None, max_age: float = None):
+        """ Removes the oldest backups until only keep are left and the backups that are older than max_age seconds.
+            Backups are hard links so removing one never changes the others.
+        """
+        backups = Database.list_backups()
+        remove = backups[:-keep] if keep else []
+        if max_age is not None:
+            oldest = time.time() - max_age
+            remove += [backup for backup in backups
+                       if time.mktime(time.strptime(backup[:15], "%Y%m%d-%H%M%S")) < oldest and backup not in remove]
+        for backup in remove:
+            shutil.rmtree(os.path.join(Database.backup_folder_path, backup))
+
+    @staticmethod
+    def restore_backup(timestamp: str, document_names: list[str] = "all_of_them"):
+        """
+        Puts documents back like they were in the backup with timestamp, the name of its folder.
+        Documents that are not there anymore are created again.
+        :param timestamp: The name of the backup folder, see list_backups.
+        :param document_names: The documents to restore, all the documents in the backup by default.
+        """
+        backup_path = os.path.join(Database.backup_folder_path, timestamp)
+        assert os.path.isdir(backup_path), "There is no backup with that timestamp."
+        files = os.listdir(backup_path)
+        shards = {file[:-7]: _shard_count(os.path.join(backup_path, file))
+                  for file in files if file.endswith(".shards")}
+        if document_names == "all_of_them":
+            shard_files = {f"{name}.shard{shard}.json" for name, count in shards.items() for shard in range(count)}
+            document_names = list(shards) + [file[:-5] for file in files
+                                             if file.endswith(".json") and file not in shard_files]
+
+        for document_name in document_names:
+            if document_name.endswith(".json"):
+                document_name = document_name[:-5]
+            if document_name in shards:
+                assert document_name not in Database.locks, "This document is not sharded anymore."
+                assert Database.__shards.get(document_name, shards[document_name]) == shards[document_name], \
+                    "This document has a different amount of shards now."
+                documents = [f"{document_name}.shard{shard}" for shard in range(shards[document_name])]
+            else:
+                assert os.path.exists(os.path.join(backup_path, document_name + ".json")), \
+                    f"{document_name} is not in this backup."
+                assert document_name not in Database.__shards, "This document is sharded now."
+                documents = [document_name]
+            for document in documents:
+                Database.locks.setdefault(document, RWLock())
+            if document_name in shards:
+                Database.__shards[document_name] = shards[document_name]
+                shutil.copy2(os.path.join(backup_path, document_name + ".shards"), Database.my_path)
+            with Database.get_lock(document_name):
+                for document in documents:
+                    Database.__restore(document, backup_path)
+
+    @staticmethod
+    def __restore(name: str, backup_path: str):
+        """ Replaces <name>.json with the one in backup_path without a lock. """
+        with open(os.path.join(backup_path, name + ".json"), "rb") as backup_file:
+            raw = backup_file.read()
+        try:
+            journal_file = open(os.path.join(backup_path, name + ".wal"))
+        except FileNotFoundError:
+            if _compression_of(raw) != Database.compressions.get(name, Database.compression):
+                return Database.__write(name, Database.__decode(raw))  # Compressed for the backup
+            Database.__replace(os.path.join(Database.my_path, name + ".json"), raw)
+            Database.__written(name, raw, None, None, None)
+            return
+        with journal_file:
+            journal_file.readline()
+            records = [json.loads(line) for line in journal_file]
+        Database.__write(name, Database.__replay(Database.__decode(raw), records))
 
     def __contains__(self, key):
         """ This can cause a deadlock if you are not carefull.
@@ -254,5 +2806,120 @@ class Database(UserDict):
         if self.__in_with:
             return key in self.data  # Check if the key is in the data that __enter__ read.
         else:
-            with self.lock:  # Lock read
-                return key in self.reads()
+            name = Database.__route(self.name, key)
+            with Database.get_lock(name).shared():  # Lock read
+                return key in Database.__read(name)
+
+
+class AsyncDatabase:
+    """
+    The Database for asyncio. The reading, parsing, serializing and writing is done in AsyncDatabase.executor so the
+    event loop is never blocked, also not for big documents.
+
+    await AsyncDatabase.read(name), add, append, delete, translate and write work like the ones from Database.
+    Writes to a document wait for each other on an asyncio.Lock first so they do not all take up a thread of the
+    executor while they wait for the lock of the document.
+
+    The async with statement works like the with statement of Database:
+
+    async with AsyncDatabase('users') as db:
+        db['quinten']['status'] = 'cool'
+
+    executor can be any concurrent.futures executor. None is the default executor of the loop. With a
+    ProcessPoolExecutor also set Database.file_locks = True so the processes lock each other out. The async with
+    statement keeps the data in this process so it always uses a thread.
+    """
+
+    executor = None
+    __locks = weakref.WeakKeyDictionary()  # loop -> {name -> asyncio.Lock}, an asyncio.Lock only works in one loop
+
+    def __init__(self, name: str, readonly: bool = False):
+        self.__database = Database(name, readonly=readonly)
+        self.__readonly = readonly
+
+    @property
+    def name(self) -> str:
+        return self.__database.name
+
+    @staticmethod
+    def get_lock(name: str) -> asyncio.Lock:
+        """ Returns the asyncio lock for name in the running loop. """
+        return AsyncDatabase.__locks.setdefault(asyncio.get_running_loop(), {}).setdefault(name, asyncio.Lock())
+
+    @staticmethod
+    async def __run(function, *args, thread: bool = False):
+        executor = AsyncDatabase.executor
+        if thread and isinstance(executor, ProcessPoolExecutor):
+            executor = None
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    @staticmethod
+    async def read(name: str) -> dict:
+        """ Will read <name>.json without blocking the loop. """
+        return await AsyncDatabase.__run(Database.read, name)
+
+    @staticmethod
+    async def translate(name: str, key):
+        """ Will translate a name to the corresponding ID without blocking the loop. """
+        return await AsyncDatabase.__run(Database.translate, name, key)
+
+    @staticmethod
+    async def write(name: str, data: dict):
+        """ Will write data to <name>.json without blocking the loop. """
+        async with AsyncDatabase.get_lock(name):
+            return await AsyncDatabase.__run(Database.write, name, data)
+
+    @staticmethod
+    async def add(name: str, key: str, data):
+        """ Will add data under key in <name>.json without blocking the loop. """
+        async with AsyncDatabase.get_lock(name):
+            return await AsyncDatabase.__run(Database.add, name, key, data)
+
+    @staticmethod
+    async def append(name: str, data):
+        """ Will append data to the list named <name> in <name>.json without blocking the loop. """
+        async with AsyncDatabase.get_lock(name):
+            return await AsyncDatabase.__run(Database.append, name, data)
+
+    @staticmethod
+    async def delete(name: str, key: str):
+        """ Will remove key from <name>.json without blocking the loop. """
+        async with AsyncDatabase.get_lock(name):
+            return await AsyncDatabase.__run(Database.delete, name, key)
+
+    async def __aenter__(self) -> Database:
+        if self.__readonly:
+            return await self.__enter()
+        lock = self.get_lock(self.name)
+        await lock.acquire()
+        try:
+            return await self.__enter()
+        except BaseException:
+            lock.release()
+            raise
+
+    async def __enter(self) -> Database:
+        entering = asyncio.ensure_future(self.__run(self.__database.__enter__, thread=True))
+        try:
+            return await asyncio.shield(entering)
+        except asyncio.CancelledError:
+            # The thread can not be stopped, so wait until it has the lock of the document and give it back
+            await asyncio.wait([entering])
+            if entering.exception() is None:
+                await self.__run(self.__database.__exit__, asyncio.CancelledError, None, None, thread=True)
+            raise
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            await self.__run(self.__database.__exit__, exc_type, exc_val, exc_tb, thread=True)
+        finally:
+            if not self.__readonly:
+                self.get_lock(self.name).release()
+
+
+if hasattr(os, "register_at_fork"):
+    # A forked process, like one from multiprocessing, would get copies of the locks that do not lock out this process.
+    # Turning file_locks on before the fork makes this process and its children use file locks, which do.
+    os.register_at_fork(before=lambda: setattr(Database, "file_locks", True))
+
+_roll_forward(Database.my_path)
@@ -1,8 +1,21 @@
+import copy
 import time
 import unittest
 import json
 import os
-from database_manager import Database
+import multiprocessing
+import asyncio
+import gzip
+import shutil
+import subprocess
+import sys
+import tempfile
+from dataclasses import dataclass, field
+from typing import Dict, List, Literal, Optional
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+from database_manager import Database, AsyncDatabase, FileLock, RWLock, LazyDocument, orjson, msgpack, zstandard, \
+    _roll_forward, _Reader
 from threading import Thread
 
 test_name = "___testing"
@@ -15,6 +28,27 @@ test_data = {
 }
 
 
+@dataclass
+class Profile:
+    __slots__ = ("city",)
+    city: str
+
+
+@dataclass
+class User:
+    __slots__ = ("name", "age", "status", "profile")
+    name: str
+    age: int
+    status: Literal["cool", "uncool"]
+    profile: Optional[Profile]
+
+
+@dataclass
+class Settings:
+    theme: str
+    events: List[int] = field(default_factory=list)
+
+
 class TestDbStatic(unittest.TestCase):
 
     def setUp(self) -> None:
@@ -71,6 +105,12 @@ class TestDbStatic(unittest.TestCase):
         self.assertIn("hi2", data[test_name])
         Database.append(test_name, "hi")
 
+    def test_delete(self):
+        Database.delete(test_name, "test")
+        self.assertNotIn("test", Database.read(test_name))
+        Database.delete(test_name, "test")  # Deleting a key that is not there is fine
+        self.assertEqual(len(Database.read(test_name)), len(test_data) - 1)
+
     def test_translate(self):
         self.assertEqual(Database.translate(test_name, "test"), "test")
         self.assertEqual(Database.translate(test_name, "1"), 1)
@@ -185,6 +225,50 @@ class TestDatabaseInstance(unittest.TestCase):
         self.assertNotIn("aapje", data)
         self.assertNotIn("aaa", data)
 
+    def test_context_manager_without_changes_does_not_write(self):
+        with Database(test_name) as db:
+            self.assertEqual(db["list"][2]["3"], 3)
+            list(db["dict"].items())
+            with open(test_filename, "w") as f:  # Someone else changed the file, this should not be overwritten
+                json.dump({"outside": "change"}, f)
+        self.assertEqual(Database.read(test_name), {"outside": "change"})
+
+    def test_context_manager_nested_changes(self):
+        with Database(test_name) as db:
+            db["list"][2]["3"] = 4
+        self.assertEqual(Database.read(test_name)["list"][2], {"3": 4})
+
+        with Database(test_name) as db:
+            for item in db["list"]:
+                if isinstance(item, dict):
+                    item["new"] = True
+            db["dict"].setdefault("other", []).append(1)
+        data = Database.read(test_name)
+        self.assertEqual(data["list"][2], {"3": 4, "new": True})
+        self.assertEqual(data["dict"]["other"], [1])
+
+    def test_context_manager_copies(self):
+        Database.write(test_name, {"a": {"b": {"c": 1}}, "l": [[1]]})
+        with Database(test_name) as db:
+            dict(db["a"])["b"]["c"] = 2
+        self.assertEqual(Database.read(test_name)["a"], {"b": {"c": 2}})
+        with Database(test_name) as db:
+            {**db["a"]}["b"]["c"] = 3
+        self.assertEqual(Database.read(test_name)["a"], {"b": {"c": 3}})
+        with Database(test_name) as db:
+            copy.copy(dict(db))["l"][0].append(2)
+        self.assertEqual(Database.read(test_name)["l"], [[1, 2]])
+
+    def test_context_manager_changed_keys(self):
+        db = Database(test_name)
+        with db:
+            db["dict"]["test"] = "changed"
+            db["list"].sort(key=str)
+            self.assertEqual(db.__dict__["_Database__changes"].keys, {"dict", "list"})
+            db.clear()
+            self.assertEqual(db.__dict__["_Database__changes"].keys, set(test_data))
+        self.assertEqual(Database.read(test_name), {})
+
     def test_thread_save(self):
         """ This should take 1 second showing that the threads waited on each other"""
         db = Database(test_name)
@@ -211,6 +295,1204 @@ class TestDatabaseInstance(unittest.TestCase):
         self.assertAlmostEqual(s1 - s, wait_time * 2, 1)  # times 2 because there are 2 threads
 
 
+class TestDocumentCache(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, test_data, replace=True)
+        Database.cache_size = 1024 * 1024
+        Database.clear_cache()
+
+    def tearDown(self) -> None:
+        Database.cache_size = 0
+        Database.clear_cache()
+        os.remove(test_filename)
+
+    def test_cache_hit(self):
+        self.assertEqual(Database.read(test_name), test_data)
+        self.assertEqual(Database.read(test_name), test_data)
+        info = Database.cache_info()
+        self.assertEqual(info["misses"], 1)
+        self.assertEqual(info["hits"], 1)
+        self.assertEqual(info["documents"], 1)
+
+    def test_cache_returns_copies(self):
+        data = Database.read(test_name)
+        data["list"].append("changed")
+        self.assertEqual(Database.read(test_name), test_data)
+
+    def test_cache_write_through(self):
+        Database.write(test_name, {1: "int keys become strings"})
+        self.assertEqual(Database.read(test_name), {"1": "int keys become strings"})
+        self.assertEqual(Database.cache_info()["misses"], 0)
+
+    def test_cache_sees_outside_changes(self):
+        Database.read(test_name)
+        with open(test_filename, "w") as f:
+            json.dump({"changed": "outside"}, f)
+        self.assertEqual(Database.read(test_name), {"changed": "outside"})
+
+    def test_cache_eviction(self):
+        Database.cache_size = 1
+        Database.read(test_name)
+        self.assertEqual(Database.cache_info()["documents"], 0)
+        self.assertEqual(Database.cache_info()["used"], 0)
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, test_data, replace=True)
+        Database.journal = True
+
+    def tearDown(self) -> None:
+        Database.journal = False
+        Database.journal_compact_size = 1024 * 1024
+        os.remove(test_filename)
+        if os.path.exists(test_name + ".wal"):
+            os.remove(test_name + ".wal")
+
+    def test_journal_does_not_rewrite_document(self):
+        Database.add(test_name, "some_key", "some_data")
+        Database.delete(test_name, "test")
+        with open(test_filename) as f:
+            self.assertEqual(json.load(f), test_data)
+        self.assertTrue(os.path.exists(test_name + ".wal"))
+        data = Database.read(test_name)
+        self.assertEqual(data["some_key"], "some_data")
+        self.assertNotIn("test", data)
+
+    def test_journal_append(self):
+        db = Database(test_name)
+        db.appends("hi")
+        db.appends("hi2")
+        self.assertEqual(db.reads()[test_name], ["hi", "hi2"])
+
+    def test_journal_bad_append(self):
+        Database.add(test_name, test_name, {"not": "a list"})
+        Database.append(test_name, "hi")
+        self.assertEqual(Database.read(test_name)[test_name], {"not": "a list"})
+        self.assertEqual(Database.get_path(test_name, [test_name, "not"]), "a list")
+        Database.journal_compact_size = 0
+        Database.append(test_name, "hi2")  # Compacts
+        with open(test_filename) as f:
+            self.assertEqual(json.load(f), dict(test_data, **{test_name: {"not": "a list"}}))
+        with Database(test_name) as db:
+            db["new"] = 1
+        self.assertEqual(Database.read(test_name)["new"], 1)
+
+    def test_journal_compaction(self):
+        Database.journal_compact_size = 0
+        Database.add(test_name, "some_key", "some_data")
+        self.assertFalse(os.path.exists(test_name + ".wal"))
+        with open(test_filename) as f:
+            self.assertEqual(json.load(f)["some_key"], "some_data")
+
+    def test_stale_journal_is_ignored(self):
+        Database.add(test_name, "some_key", "some_data")
+        with open(test_name + ".wal") as f:
+            journal = f.read()
+        Database.write(test_name, {"new": "data"})
+        with open(test_name + ".wal", "w") as f:  # Pretend the write died before it could remove the journal
+            f.write(journal)
+        self.assertEqual(Database.read(test_name), {"new": "data"})
+        Database.add(test_name, "other_key", 1)
+        self.assertEqual(Database.read(test_name), {"new": "data", "other_key": 1})
+
+    def test_journal_with_context_manager(self):
+        Database.add(test_name, "some_key", "some_data")
+        with Database(test_name) as db:
+            self.assertEqual(db["some_key"], "some_data")
+            db["other_key"] = 1
+        self.assertFalse(os.path.exists(test_name + ".wal"))
+        self.assertEqual(Database.read(test_name)["other_key"], 1)
+
+
+class TestRWLock(unittest.TestCase):
+    def test_readers_share(self):
+        lock = RWLock()
+        self.assertTrue(lock.acquire_shared())
+        self.assertTrue(lock.acquire_shared(blocking=False))
+        self.assertFalse(lock.acquire(timeout=0.05))
+        lock.release_shared()
+        lock.release_shared()
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertFalse(lock.acquire_shared(blocking=False))
+        lock.release()
+
+    def test_waiting_writer_blocks_new_readers(self):
+        lock = RWLock()
+        lock.acquire_shared()
+        writer = Thread(target=lambda: (lock.acquire(), lock.release()))
+        writer.start()
+        time.sleep(0.05)
+        self.assertFalse(lock.acquire_shared(timeout=0.05))  # The writer is waiting so this reader has to wait
+        lock.release_shared()
+        writer.join()
+        self.assertTrue(lock.acquire_shared(blocking=False))
+        lock.release_shared()
+
+
+class TestReadonly(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, test_data, replace=True)
+
+    def tearDown(self) -> None:
+        os.remove(test_filename)
+
+    def test_readonly_does_not_write(self):
+        with Database(test_name, readonly=True) as db:
+            self.assertIn("test", db)
+            db["aapje"] = "aapje"
+        self.assertNotIn("aapje", Database.read(test_name))
+
+    def test_readonly_in_parallel(self):
+        """ This should take 0.5 seconds showing that the readers did not wait on each other """
+        wait_time = 0.5
+
+        def thread_read():
+            with Database(test_name, readonly=True) as db:
+                time.sleep(wait_time)
+                self.assertEqual(db["test"], "test")
+
+        s = time.time()
+        threads = [Thread(target=thread_read) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertAlmostEqual(time.time() - s, wait_time, 1)
+
+
+def process_adds(process_id: int, amount: int):
+    """ Runs in a separate process that does not share any locks with the test process """
+    Database.file_locks = True
+    for i in range(amount):
+        Database.add(test_name, f"{process_id}-{i}", i)
+
+
+def fork_adds(process_id: int, amount: int):
+    """ Runs in a forked process without setting file_locks """
+    for i in range(amount):
+        Database.add(test_name, f"{process_id}-{i}", i)
+
+
+class TestFileLocks(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, test_data, replace=True)
+        Database.file_locks = True
+
+    def tearDown(self) -> None:
+        Database.file_locks = False
+        os.remove(test_filename)
+        if os.path.exists(test_name + ".lock"):
+            os.remove(test_name + ".lock")
+
+    def test_get_lock(self):
+        self.assertIsInstance(Database.get_lock(test_name), FileLock)
+        self.assertIs(Database.get_lock(test_name), Database(test_name).lock)
+
+    def test_exclusive_and_shared(self):
+        lock = Database.get_lock(test_name)
+        other = FileLock(lock.path)  # Like the lock in another process
+        with lock:
+            self.assertFalse(other.acquire(timeout=0.05))
+            self.assertFalse(other.acquire_shared(blocking=False))
+        self.assertTrue(lock.acquire_shared())
+        self.assertTrue(other.acquire_shared(timeout=0.05))
+        self.assertFalse(other.acquire(timeout=0.05))
+        lock.release_shared()
+        other.release_shared()
+        self.assertTrue(other.acquire(blocking=False))
+        other.release()
+
+    def test_processes_do_not_lose_writes(self):
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=process_adds, args=(process_id, 20)) for process_id in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        data = Database.read(test_name)
+        for process_id in range(4):
+            for i in range(20):
+                self.assertEqual(data[f"{process_id}-{i}"], i)
+
+    @unittest.skipUnless(hasattr(os, "register_at_fork"), "Only forked processes inherit the locks")
+    def test_forked_processes_do_not_lose_writes(self):
+        Database.file_locks = False
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=fork_adds, args=(process_id, 20)) for process_id in range(3)]
+        for process in processes:
+            process.start()
+        self.assertTrue(Database.file_locks)  # Turned on by the fork
+        fork_adds(3, 20)
+        for process in processes:
+            process.join()
+        data = Database.read(test_name)
+        for process_id in range(4):
+            for i in range(20):
+                self.assertEqual(data[f"{process_id}-{i}"], i)
+
+
+class TestSerializers(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, test_data, replace=True)
+
+    def tearDown(self) -> None:
+        Database.serializer = "json"
+        Database.serializers.clear()
+        Database.compact = False
+        os.remove(test_filename)
+
+    def test_compact(self):
+        size = os.path.getsize(test_filename)
+        Database.compact = True
+        Database.write(test_name, test_data)
+        self.assertLess(os.path.getsize(test_filename), size)
+        with open(test_filename) as f:
+            self.assertNotIn("\n", f.read())
+        self.assertEqual(Database.read(test_name), test_data)
+
+    @unittest.skipIf(orjson is None, "orjson is not installed")
+    def test_orjson(self):
+        Database.serializer = "orjson"
+        Database.write(test_name, {1: "int keys become strings", "b": [1.5, None]})
+        with open(test_filename) as f:
+            self.assertEqual(json.load(f), {"1": "int keys become strings", "b": [1.5, None]})
+        with self.assertRaises(TypeError):
+            with Database(test_name) as db:
+                db["aapje"] = Exception
+        self.assertNotIn("aapje", Database.read(test_name))
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack_per_document(self):
+        Database.serializers[test_name] = "msgpack"
+        Database.write(test_name, test_data)
+        with open(test_filename, "rb") as f:
+            self.assertEqual(msgpack.unpackb(f.read()), test_data)
+        self.assertEqual(Database.read(test_name), test_data)
+        del Database.serializers[test_name]  # Switching back is detected on read
+        Database.add(test_name, "some_key", "some_data")
+        self.assertEqual(Database.read(test_name)["some_key"], "some_data")
+
+
+users = {
+    "quinten": {"status": "cool", "age": 25, "profile": {"city": "Amsterdam"}},
+    "foo": {"status": "bar", "age": 17, "profile": {"city": "Utrecht"}},
+    "baz": {"status": "cool", "age": 40},
+    "qux": {"status": None, "age": "unknown"}
+}
+
+
+class TestQuery(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, users, replace=True)
+
+    def tearDown(self) -> None:
+        Database.journal = False
+        os.remove(test_filename)
+        if os.path.exists(test_name + ".index"):
+            Database.drop_index(test_name, "status")
+            Database.drop_index(test_name, "age")
+            Database.drop_index(test_name, "profile.city")
+            Database.drop_index(test_name, "0")
+        if os.path.exists(test_name + ".wal"):
+            os.remove(test_name + ".wal")
+
+    def assertQueries(self):
+        """ The same queries have to give the same answer with and without indexes """
+        self.assertEqual(set(Database.query(test_name, {"status": "cool"})), {"quinten", "baz"})
+        self.assertEqual(set(Database.query(test_name, {"age": (">=", 18)})), {"quinten", "baz"})
+        self.assertEqual(set(Database.query(test_name, {"age": ("<", 30), "status": ("in", ["cool", "bar"])})),
+                         {"quinten", "foo"})
+        self.assertEqual(set(Database.query(test_name, {"status": None})), {"qux"})
+        self.assertEqual(Database.query(test_name, {"profile.city": "Utrecht"}, fields=["age"]), {"foo": {"age": 17}})
+        self.assertEqual(Database.query(test_name, {"status": "cool", "age": (">", 30)}), {"baz": users["baz"]})
+
+    def test_query_scan(self):
+        self.assertQueries()
+        self.assertEqual(set(Database.query(test_name, lambda user: user["age"] == "unknown")), {"qux"})
+        self.assertEqual(Database(test_name).queries(fields=["status"])["foo"], {"status": "bar"})
+
+    def test_query_index(self):
+        Database.create_index(test_name, "status")
+        Database.create_index(test_name, "age", "sorted")
+        Database.create_index(test_name, "profile.city")
+        self.assertTrue(os.path.exists(test_name + ".index"))
+        self.assertQueries()
+        # Answered from the index alone
+        self.assertEqual(Database.query(test_name, {"status": "cool"}, fields=["age"]),
+                         {"baz": {"age": 40}, "quinten": {"age": 25}})
+
+    def test_index_follows_writes(self):
+        Database.create_index(test_name, "status")
+        Database.create_index(test_name, "age", "sorted")
+        Database.add(test_name, "new", {"status": "cool", "age": 18})
+        Database.delete(test_name, "baz")
+        with Database(test_name) as db:
+            db["foo"]["status"] = "cool"
+        self.assertEqual(set(Database.query(test_name, {"status": "cool"})), {"quinten", "new", "foo"})
+        self.assertEqual(set(Database.query(test_name, {"age": ("<=", 18)})), {"new", "foo"})
+        Database.journal = True
+        Database.add(test_name, "journaled", {"status": "cool", "age": 1})
+        Database.delete(test_name, "quinten")
+        self.assertEqual(set(Database.query(test_name, {"status": "cool"})), {"new", "foo", "journaled"})
+
+    def test_index_follows_journal_append(self):
+        Database.create_index(test_name, "0")
+        Database.journal = True
+        Database.append(test_name, "x")
+        self.assertEqual(Database.query(test_name, {"0": "x"}), {test_name: ["x"]})
+        Database.append(test_name, "y")
+        self.assertEqual(Database.query(test_name, {"0": "x"}, fields=["1"]), {test_name: {"1": "y"}})
+
+    def test_index_is_persisted(self):
+        Database.create_index(test_name, "age", "sorted")
+        Database._Database__indexes.clear()  # Like a restart
+        self.assertEqual(set(Database.query(test_name, {"age": (">", 18)})), {"quinten", "baz"})
+        with open(test_filename, "w") as f:  # Changed without updating the index
+            json.dump({"other": {"age": 50}}, f)
+        self.assertEqual(set(Database.query(test_name, {"age": (">", 18)})), {"other"})
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, dict(test_data, **{test_name: [1, 2]}), replace=True)
+
+    def tearDown(self) -> None:
+        Database.journal = False
+        os.remove(test_filename)
+        if os.path.exists(test_name + ".wal"):
+            os.remove(test_name + ".wal")
+
+    def test_iter_items(self):
+        self.assertEqual(dict(Database.iter_items(test_name)), Database.read(test_name))
+        self.assertEqual(list(Database.iter_items(test_name, "list")), [(0, "1"), (1, 2), (2, {"3": 3})])
+        self.assertEqual(dict(Database.iter_items(test_name, "dict")), {"test": "data"})
+        with self.assertRaises(KeyError):
+            list(Database.iter_items(test_name, "not_there"))
+
+    def test_get_path(self):
+        self.assertEqual(Database.get_path(test_name, "list.2.3"), 3)
+        self.assertEqual(Database.get_path(test_name, ["dict", "test"]), "data")
+        self.assertEqual(Database.get_path(test_name, "dict"), {"test": "data"})
+        with self.assertRaises(KeyError):
+            Database.get_path(test_name, "list.5")
+
+    def test_streaming_with_journal(self):
+        Database.journal = True
+        Database.journal_compact_ratio = 100
+        try:
+            Database.append(test_name, 3)
+            Database.add(test_name, "new", {"a": [1]})
+            Database.delete(test_name, "test")
+        finally:
+            Database.journal_compact_ratio = 1.0
+        self.assertTrue(os.path.exists(test_name + ".wal"))
+        self.assertEqual([item for _, item in Database.iter_items(test_name, test_name)], [1, 2, 3])
+        self.assertEqual(Database.get_path(test_name, "new.a.0"), 1)
+        self.assertEqual(dict(Database.iter_items(test_name)), Database.read(test_name))
+        with Database.lazy(test_name) as document:
+            self.assertEqual(dict(document), Database.read(test_name))
+
+    def test_small_windows(self):
+        data = {"k": [0.1, 12500.0, -3e-05, 7, 1e+20], "ünïcode": "ありがとう ✓", "n": 0.25, "t": True}
+        old = _Reader.window_size
+        try:
+            for compact in (False, True):  # Compact json has more numbers right at the end of a window
+                Database.compact = compact
+                Database.write(test_name, data)
+                for size in range(1, 8):
+                    _Reader.window_size = size
+                    self.assertEqual(dict(Database.iter_items(test_name)), data)
+                    self.assertEqual([Database.get_path(test_name, ["k", i]) for i in range(5)], data["k"])
+                    self.assertEqual(Database.get_path(test_name, "n"), 0.25)
+                    with Database.lazy(test_name) as document:
+                        self.assertEqual(dict(document), data)
+        finally:
+            _Reader.window_size = old
+            Database.compact = False
+
+    def test_lazy(self):
+        with Database.lazy(test_name) as document:
+            self.assertIsInstance(document, LazyDocument)
+            self.assertEqual(set(document), set(test_data) | {test_name})
+            self.assertEqual(document.loaded(), [])
+            self.assertEqual(document["dict"], {"test": "data"})
+            self.assertEqual(document.loaded(), ["dict"])
+            Database.write(test_name, {})  # The view keeps the version it was made from
+            self.assertEqual(document["list"], test_data["list"])
+
+
+class TestSharding(unittest.TestCase):
+    shard_name = "___sharded"
+
+    def setUp(self) -> None:
+        self.data = {f"key{number}": {"number": number} for number in range(20)}
+        Database.create(self.shard_name, self.data, shards=4)
+
+    def tearDown(self) -> None:
+        for shard in range(4):
+            os.remove(f"{self.shard_name}.shard{shard}.json")
+            del Database.locks[f"{self.shard_name}.shard{shard}"]
+        os.remove(self.shard_name + ".shards")
+        del Database._Database__shards[self.shard_name]
+
+    def shard_files(self):
+        return {shard: os.stat(f"{self.shard_name}.shard{shard}.json").st_ino for shard in range(4)}
+
+    def test_create(self):
+        self.assertEqual(Database.read(self.shard_name), self.data)
+        self.assertFalse(os.path.exists(self.shard_name + ".json"))
+        self.assertTrue(all(Database.read(f"{self.shard_name}.shard{shard}") for shard in range(4)))
+        self.assertIsNone(Database.create(self.shard_name, {}))  # Already there
+        with self.assertRaises(AssertionError):
+            Database.create(self.shard_name, {}, replace=True, shards=2)
+
+    def test_add_writes_one_shard(self):
+        before = self.shard_files()
+        Database.add(self.shard_name, "key3", "new")
+        Database.delete(self.shard_name, "key4")
+        after = self.shard_files()
+        self.assertLessEqual(sum(before[shard] != after[shard] for shard in before), 2)
+        self.data["key3"] = "new"
+        del self.data["key4"]
+        self.assertEqual(Database.read(self.shard_name), self.data)
+        self.assertEqual(Database.translate(self.shard_name, "key3"), "new")
+
+    def test_with_writes_changed_shards(self):
+        before = self.shard_files()
+        with Database(self.shard_name) as db:
+            db["key5"]["number"] = -5
+        after = self.shard_files()
+        self.assertEqual(sum(before[shard] != after[shard] for shard in before), 1)
+        db = Database(self.shard_name)
+        self.assertIn("key5", db)
+        self.assertNotIn("key50", db)
+        self.assertEqual(db.translates("key5"), {"number": -5})
+
+    def test_many(self):
+        Database.add_many(self.shard_name, {"key1": 1, "key2": 2, "new": 3})
+        Database.delete_many(self.shard_name, ["key3", "key4"])
+        self.data.update(key1=1, key2=2, new=3)
+        del self.data["key3"], self.data["key4"]
+        self.assertEqual(Database.read(self.shard_name), self.data)
+
+    def test_streaming(self):
+        self.assertEqual(Database.get_path(self.shard_name, "key7.number"), 7)
+        self.assertEqual(dict(Database.iter_items(self.shard_name)), self.data)
+        self.assertEqual(dict(Database.lazy(self.shard_name)), self.data)
+
+
+class TestTransactions(unittest.TestCase):
+    other_name = "___testing2"
+
+    def setUp(self) -> None:
+        Database.create(test_name, test_data, replace=True)
+        Database.create(self.other_name, {"count": 0}, replace=True)
+
+    def tearDown(self) -> None:
+        Database.group_commit = False
+        for name in (test_name, self.other_name):
+            os.remove(name + ".json")
+            if os.path.exists(name + ".wal"):
+                os.remove(name + ".wal")
+            del Database.locks[name]
+
+    def test_transaction(self):
+        with Database.transaction([self.other_name, test_name]) as documents:
+            documents[test_name]["dict"]["new"] = 1
+            documents[self.other_name]["count"] += 1
+        self.assertEqual(Database.read(test_name)["dict"], {"test": "data", "new": 1})
+        self.assertEqual(Database.read(self.other_name), {"count": 1})
+        self.assertEqual([file for file in os.listdir() if file.endswith(".tmp")], [])
+        self.assertEqual(os.listdir(".transactions"), [])
+
+    def test_all_or_nothing(self):
+        with self.assertRaises(ValueError):
+            with Database.transaction([test_name, self.other_name]) as documents:
+                documents[self.other_name]["count"] = 1
+                raise ValueError
+        with self.assertRaises(TypeError):  # Can not be serialized so the other document is not written either
+            with Database.transaction([test_name, self.other_name]) as documents:
+                documents[self.other_name]["count"] = 1
+                documents[test_name]["bad"] = Exception
+        self.assertEqual(Database.read(test_name), test_data)
+        self.assertEqual(Database.read(self.other_name), {"count": 0})
+        self.assertEqual([file for file in os.listdir() if file.endswith(".tmp")], [])
+
+    def test_no_deadlock(self):
+        def move(names):
+            for _ in range(20):
+                with Database.transaction(names) as documents:
+                    documents[self.other_name]["count"] += 1
+                    documents[test_name]["1"] += 1
+
+        threads = [Thread(target=move, args=(names,))
+                   for names in ([test_name, self.other_name], [self.other_name, test_name])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(Database.read(self.other_name), {"count": 40})
+        self.assertEqual(Database.read(test_name)["1"], 41)
+
+    def test_roll_forward(self):
+        with open(test_filename + ".1.1.tmp", "w") as f:
+            json.dump({"rolled": "forward"}, f)
+        manifest_path = os.path.join(".transactions", f"{os.getpid()}.1.transaction")
+        os.makedirs(".transactions", exist_ok=True)
+        with open(manifest_path, "w") as f:
+            json.dump([[test_filename + ".1.1.tmp", test_filename], ["gone.tmp", self.other_name + ".json"]], f)
+        _roll_forward(".")
+        self.assertEqual(Database.read(test_name), {"rolled": "forward"})
+        self.assertEqual(Database.read(self.other_name), {"count": 0})  # Was already renamed
+        self.assertFalse(os.path.exists(manifest_path))
+
+    def test_group_commit(self):
+        Database.group_commit = True
+        Database.group_commit_window = 0.05
+        Database.create(self.other_name, {self.other_name: []}, replace=True)
+        errors = []
+
+        def add(number):
+            try:
+                if number == 3:
+                    Database.append(test_name, number)  # There is no list named ___testing
+                else:
+                    Database.append(self.other_name, number)
+            except KeyError as error:
+                errors.append(error)
+
+        inode = os.stat(self.other_name + ".json").st_ino
+        threads = [Thread(target=add, args=(number,)) for number in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(Database.read(self.other_name)[self.other_name]), [0, 1, 2, 4, 5, 6, 7, 8, 9])
+        self.assertNotEqual(os.stat(self.other_name + ".json").st_ino, inode)
+        self.assertEqual(len(errors), 1)
+        Database.add(self.other_name, "key", "value")
+        self.assertEqual(Database.translate(self.other_name, "key"), "value")
+
+    def test_group_commit_write_error(self):
+        Database.group_commit = True
+        Database.group_commit_window = 0.05
+        Database.journal = True
+        Database.journal_compact_size = 0  # Every append compacts, after its records are in the journal
+        Database.create(self.other_name, {self.other_name: []}, replace=True)
+        replace = Database._Database__replace
+        failed = []
+
+        def fail_once(path, raw):
+            if not failed:
+                failed.append(path)
+                raise OSError("disk full")
+            return replace(path, raw)
+
+        errors = []
+
+        def add(number):
+            try:
+                Database.append(self.other_name, number)
+            except OSError as error:
+                errors.append(error)
+
+        try:
+            with mock.patch.object(Database, "_Database__replace", fail_once):
+                threads = [Thread(target=add, args=(number,)) for number in range(3)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            Database.journal = False
+            Database.journal_compact_size = 1024 * 1024
+        self.assertEqual(len(errors), 3)  # Not retried one by one, that would append them twice
+        self.assertEqual(sorted(Database.read(self.other_name)[self.other_name]), [0, 1, 2])
+
+
+class TestAsyncDatabase(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, dict(test_data, **{test_name: []}), replace=True)
+
+    def tearDown(self) -> None:
+        AsyncDatabase.executor = None
+        Database.file_locks = False  # Turned on when the process pool forked
+        os.remove(test_filename)
+        if os.path.exists(test_name + ".lock"):
+            os.remove(test_name + ".lock")
+
+    def test_static(self):
+        async def run():
+            await AsyncDatabase.add(test_name, "new", {"a": 1})
+            await asyncio.gather(*(AsyncDatabase.append(test_name, number) for number in range(10)))
+            await AsyncDatabase.delete(test_name, "test")
+            self.assertEqual(await AsyncDatabase.translate(test_name, "new"), {"a": 1})
+            return await AsyncDatabase.read(test_name)
+
+        data = asyncio.run(run())
+        self.assertEqual(sorted(data[test_name]), list(range(10)))
+        self.assertNotIn("test", data)
+        self.assertEqual(data, Database.read(test_name))
+
+    def test_async_with(self):
+        async def change(number):
+            async with AsyncDatabase(test_name) as db:
+                await asyncio.sleep(0)
+                db[test_name].append(number)
+
+        async def fail():
+            async with AsyncDatabase(test_name) as db:
+                db["failed"] = True
+                raise KeyError
+
+        async def run():
+            await asyncio.gather(*(change(number) for number in range(5)))
+            with self.assertRaises(KeyError):
+                await fail()
+            async with AsyncDatabase(test_name, readonly=True) as db:
+                return dict(db)
+
+        data = asyncio.run(run())
+        self.assertEqual(sorted(data[test_name]), list(range(5)))
+        self.assertNotIn("failed", data)
+
+    def test_loop_not_blocked(self):
+        Database.write(test_name, {str(number): list(range(100)) for number in range(3000)})
+
+        async def run():
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0)
+
+            ticker = asyncio.ensure_future(tick())
+            await asyncio.sleep(0)
+            before = ticks
+            async with AsyncDatabase(test_name) as db:
+                db["new"] = 1
+            await AsyncDatabase.read(test_name)
+            ticker.cancel()
+            return ticks - before
+
+        self.assertGreater(asyncio.run(run()), 2)
+
+    def test_process_pool(self):
+        with ProcessPoolExecutor(1) as executor:
+            AsyncDatabase.executor = executor
+            self.assertEqual(asyncio.run(AsyncDatabase.read(test_name))["dict"], test_data["dict"])
+
+
+class TestDiscovery(unittest.TestCase):
+    def tearDown(self) -> None:
+        if os.path.exists(test_filename):
+            os.remove(test_filename)
+
+    def test_no_locks_on_import(self):
+        code = "import database_manager; print(len(database_manager.Database.locks))"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "0")
+
+    def test_external_document(self):
+        Database.locks.pop(test_name, None)
+        with open(test_filename, "w") as f:  # Made by another process
+            json.dump(test_data, f)
+        self.assertNotIn(test_name, dict(Database.locks))
+        self.assertEqual(Database.read(test_name), test_data)
+        self.assertIn(test_name, dict(Database.locks))
+        self.assertIsNone(Database.create(test_name, {}))  # Does not overwrite it
+        self.assertNotIn("___not_there", Database.locks)
+        with self.assertRaises(AssertionError):
+            Database("___not_there").lock
+
+    def test_names_are_not_paths(self):
+        path = Database.my_path
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                Database.set_path(os.path.join(directory, "documents"))
+                os.mkdir(Database.my_path)
+                with open(os.path.join(directory, "secret.json"), "w") as f:
+                    json.dump({"password": "hunter2"}, f)
+                for name in ("../secret", os.path.join(directory, "secret")):
+                    self.assertNotIn(name, Database.locks)
+                    with self.assertRaises(KeyError):
+                        Database.read(name)
+                    with self.assertRaises(KeyError):
+                        Database.add(name, "password", "")
+                    with self.assertRaises(AssertionError):
+                        Database.create(name, {}, replace=True)
+                with open(os.path.join(directory, "secret.json")) as f:
+                    self.assertEqual(json.load(f), {"password": "hunter2"})
+            finally:
+                Database.set_path(path)
+
+    def test_set_path(self):
+        path, backup_folder_path = Database.my_path, Database.backup_folder_path
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                Database.set_path(directory)
+                self.assertEqual(Database.backup_folder_path, os.path.join(os.path.realpath(directory),
+                                                                           Database.backup_directory_name))
+                Database.create(test_name, test_data)
+                self.assertTrue(os.path.exists(os.path.join(directory, test_filename)))
+                self.assertFalse(os.path.exists(test_filename))
+                self.assertEqual(Database.read(test_name), test_data)
+            finally:
+                Database.set_path(path)
+        self.assertEqual(Database.backup_folder_path, backup_folder_path)
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, test_data, replace=True)
+        Database.clear_stats()
+        Database.instrumentation = True
+
+    def tearDown(self) -> None:
+        Database.instrumentation = False
+        Database.hooks = []
+        Database.clear_stats()
+        os.remove(test_filename)
+
+    def test_with(self):
+        with Database(test_name) as db:
+            db["new"] = 1
+        stats = Database.stats(test_name)
+        self.assertEqual(set(stats), {"lock_wait", "lock_hold", "read", "read_bytes", "parse", "serialize", "write",
+                                      "write_bytes"})
+        self.assertEqual(stats["write_bytes"]["total"], os.path.getsize(test_filename))
+        for stat in stats.values():
+            self.assertEqual(stat["count"], 1)
+            self.assertEqual(sum(stat["histogram"].values()), 1)
+        self.assertEqual(set(Database.stats()), {test_name})
+
+    def test_lock_wait(self):
+        def hold():
+            with Database(test_name):
+                time.sleep(0.1)
+
+        thread = Thread(target=hold)
+        thread.start()
+        time.sleep(0.02)
+        Database.read(test_name)
+        thread.join()
+        stats = Database.stats(test_name)
+        self.assertGreater(stats["lock_wait"]["max"], 0.05)
+        self.assertGreater(stats["lock_hold"]["max"], 0.1)
+        self.assertEqual(stats["lock_hold"]["count"], 2)
+
+    def test_hooks_and_off(self):
+        measurements = []
+        Database.hooks.append(lambda name, metric, value: measurements.append((name, metric)))
+        Database.add(test_name, "key", "value")
+        self.assertIn((test_name, "write"), measurements)
+        self.assertIn((test_name, "lock_wait"), measurements)
+        Database.instrumentation = False
+        Database.clear_stats()
+        Database.add(test_name, "key", "value")
+        self.assertEqual(Database.stats(), {})
+        self.assertIs(Database.get_lock(test_name), Database.locks[test_name])
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, dict(test_data, **{test_name: []}), replace=True)
+        Database.watch_interval = 0.01
+
+    def tearDown(self) -> None:
+        Database.watch_interval = 0.1
+        os.remove(test_filename)
+
+    def changes_while_watching(self, change, keys=None) -> list:
+        def later():
+            time.sleep(0.05)
+            change()
+
+        thread = Thread(target=later)
+        thread.start()
+        events = list(Database.watch(test_name, keys, timeout=0.3))
+        thread.join()
+        return events
+
+    def test_watch(self):
+        def change():
+            Database.add(test_name, "new", 1)
+            Database.append(test_name, "item")
+            Database.delete(test_name, "test")
+            with Database(test_name) as db:
+                db["dict"]["test"] = "changed"
+
+        events = self.changes_while_watching(change)
+        # Changes that come in while the watcher is busy are given in the order of the keys in the document
+        self.assertCountEqual(events, [("new", None, 1), (test_name, [], ["item"]), ("test", "test", None),
+                                       ("dict", {"test": "data"}, {"test": "changed"})])
+
+    def test_keys(self):
+        def change():
+            Database.add(test_name, "new", 1)
+            Database.write(test_name, dict(test_data, **{"1": 2}))
+
+        self.assertEqual(self.changes_while_watching(change, keys=["1"]), [("1", 1, 2)])
+
+    def test_other_process(self):
+        def change():
+            with open(test_filename, "w") as f:  # Not through Database
+                json.dump({"outside": "change"}, f)
+
+        events = self.changes_while_watching(change, keys=["outside", "1"])
+        self.assertCountEqual(events, [("1", 1, None), ("outside", None, "change")])
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, {f"user{number}": {"status": "cool", "tags": ["a"]} for number in range(3)},
+                        replace=True)
+
+    def tearDown(self) -> None:
+        os.remove(test_filename)
+
+    def test_shared_and_frozen(self):
+        snapshot = Database.snapshot(test_name)
+        self.assertIs(Database.snapshot(test_name), snapshot)
+        self.assertEqual(snapshot["user0"]["tags"], ("a",))
+        with self.assertRaises(TypeError):
+            snapshot["user0"]["status"] = "not cool"
+        self.assertIs(snapshot["user0"]["status"], snapshot["user1"]["status"])
+        self.assertIs(list(snapshot["user0"])[0], list(snapshot["user2"])[0])
+
+    def test_rebuilt_after_change(self):
+        snapshot = Database.snapshot(test_name)
+        Database.add(test_name, "user0", "changed")
+        self.assertEqual(Database.snapshot(test_name)["user0"], "changed")
+        self.assertEqual(snapshot["user0"]["status"], "cool")  # The old snapshot does not change
+
+    def test_threads(self):
+        snapshots = []
+        threads = [Thread(target=lambda: snapshots.append(Database.snapshot(test_name))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len({id(snapshot) for snapshot in snapshots}), 1)
+
+
+class TestBulk(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, dict(test_data, **{test_name: []}), replace=True)
+        Database.clear_stats()
+        Database.instrumentation = True
+
+    def tearDown(self) -> None:
+        Database.instrumentation = False
+        Database.clear_stats()
+        os.remove(test_filename)
+
+    def test_add_append_delete_many(self):
+        Database.add_many(test_name, {f"key{number}": number for number in range(100)})
+        Database.append_many(test_name, (number for number in range(1000)))
+        Database.delete_many(test_name, ["test", "key0", "not_there"])
+        Database.add_many(test_name, {})
+        self.assertEqual(Database.stats(test_name)["write"]["count"], 3)
+        data = Database.read(test_name)
+        self.assertEqual(data[test_name], list(range(1000)))
+        self.assertEqual(data["key99"], 99)
+        self.assertNotIn("key0", data)
+        self.assertNotIn("test", data)
+
+    def test_many_with_journal(self):
+        Database.journal = True
+        try:
+            Database.add_many(test_name, {"a": 1, "b": 2})
+            Database.append_many(test_name, [1, 2])
+            self.assertEqual(Database.stats(test_name)["write"]["count"], 2)
+            self.assertEqual(Database.read(test_name)[test_name], [1, 2])
+        finally:
+            Database.journal = False
+        os.remove(test_name + ".wal")
+
+    def test_read_many(self):
+        Database.create("___testing2", {"other": 1}, replace=True)
+        try:
+            expected = {test_name: Database.read(test_name), "___testing2": {"other": 1}}
+            self.assertEqual(Database.read_many([test_name, "___testing2"]), expected)
+            with ProcessPoolExecutor(2) as executor:
+                self.assertEqual(Database.read_many([test_name, "___testing2"], executor), expected)
+        finally:
+            os.remove("___testing2.json")
+
+
+class TestAtomicWrites(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, test_data, replace=True)
+
+    def tearDown(self) -> None:
+        Database.durability = "none"
+        os.remove(test_filename)
+
+    def test_write_replaces_file(self):
+        with open(test_filename) as f:
+            Database.write(test_name, {"new": "data"})
+            self.assertEqual(json.load(f), test_data)  # A reader that already opened the file sees the old version
+        self.assertEqual(Database.read(test_name), {"new": "data"})
+        self.assertEqual([file for file in os.listdir() if file.endswith(".tmp")], [])
+
+    def test_failed_write_leaves_file(self):
+        with self.assertRaises(TypeError):
+            Database.write(test_name, {"bad": Exception})
+        self.assertEqual(Database.read(test_name), test_data)
+
+    def test_keeps_mode_and_symlink(self):
+        os.chmod(test_filename, 0o600)
+        Database.add(test_name, "new", 1)
+        self.assertEqual(os.stat(test_filename).st_mode & 0o777, 0o600)
+        with tempfile.TemporaryDirectory() as directory:
+            target = os.path.join(directory, "target.json")
+            os.replace(test_filename, target)
+            os.symlink(target, test_filename)
+            Database.add(test_name, "newer", 2)
+            with Database.transaction([test_name]) as documents:
+                documents[test_name]["newest"] = 3
+            self.assertTrue(os.path.islink(test_filename))
+            with open(target) as f:
+                self.assertEqual(json.load(f), dict(test_data, new=1, newer=2, newest=3))
+            self.assertEqual(os.stat(target).st_mode & 0o777, 0o600)
+
+    def test_durability(self):
+        for durability in ("file", "directory"):
+            Database.durability = durability
+            Database.write(test_name, {"durability": durability})
+            self.assertEqual(Database.read(test_name), {"durability": durability})
+
+
+class TestIncrementalBackups(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, test_data, replace=True)
+        Database.create("___testing2", {"other": 1}, replace=True)
+        Database.backup_compression = None  # See TestCompression for compressed backups
+
+    def tearDown(self) -> None:
+        Database.backup_compression = "gzip"
+        Database.journal = False
+        shutil.rmtree(Database.backup_folder_path)
+        for name in (test_name, "___testing2"):
+            if os.path.exists(name + ".wal"):
+                os.remove(name + ".wal")
+            os.remove(name + ".json")
+
+    def backup_file(self, backup, filename):
+        return os.path.join(Database.backup_folder_path, backup, filename)
+
+    def test_unchanged_documents_are_shared(self):
+        Database.create_backup([test_name, "___testing2"])
+        Database.add(test_name, "new", 1)
+        Database.create_backup([test_name, "___testing2"])
+        first, second = Database.list_backups()
+        self.assertTrue(os.path.samefile(self.backup_file(first, "___testing2.json"),
+                                         self.backup_file(second, "___testing2.json")))
+        self.assertFalse(os.path.samefile(self.backup_file(first, test_filename),
+                                          self.backup_file(second, test_filename)))
+        with open(self.backup_file(first, test_filename)) as f:
+            self.assertEqual(json.load(f), test_data)  # Writes after the backup do not change it
+
+    def test_copy_when_links_fail(self):
+        link = os.link
+
+        def link_only_backups(source, destination):
+            if not os.path.abspath(source).startswith(Database.backup_folder_path):
+                raise OSError("Cross-device link")
+            link(source, destination)
+
+        with mock.patch("database_manager.os.link", side_effect=link_only_backups):
+            Database.create_backup([test_name, "___testing2"])
+            Database.add(test_name, "new", 1)
+            Database.create_backup([test_name, "___testing2"])
+        first, second = Database.list_backups()
+        self.assertFalse(os.path.samefile(self.backup_file(first, "___testing2.json"), "___testing2.json"))
+        self.assertTrue(os.path.samefile(self.backup_file(first, "___testing2.json"),
+                                         self.backup_file(second, "___testing2.json")))
+        with open(self.backup_file(second, test_filename)) as f:
+            self.assertEqual(json.load(f), dict(test_data, new=1))
+
+    def test_restore_with_journal(self):
+        Database.journal = True
+        Database.add(test_name, "journaled", True)
+        Database.create_backup([test_name, "___testing2"])
+        backup = Database.list_backups()[-1]
+        self.assertTrue(os.path.exists(self.backup_file(backup, test_name + ".wal")))
+        Database.write(test_name, {})
+        os.remove("___testing2.json")
+        del Database.locks["___testing2"]
+        Database.restore_backup(backup)
+        self.assertEqual(Database.read(test_name), dict(test_data, journaled=True))
+        self.assertEqual(Database.read("___testing2"), {"other": 1})
+        Database.write(test_name, {})
+        Database.restore_backup(backup, [test_name])
+        self.assertEqual(Database.read(test_name), dict(test_data, journaled=True))
+
+    def test_retention(self):
+        for _ in range(4):
+            Database.create_backup([test_name], keep=3)
+        self.assertEqual(len(Database.list_backups()), 3)
+        Database.remove_backups(max_age=-60)
+        self.assertEqual(Database.list_backups(), [])
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run(self):
+        import benchmark_database_manager
+        results = benchmark_database_manager.run(sizes=["1K"], threads=[2], processes=[], ratios=[0.5], count=3,
+                                                 compressions=["gzip:1"])
+        benchmarks = {result["benchmark"] for result in results["results"]}
+        self.assertEqual(benchmarks, {"read", "write", "add", "append", "contains", "with", "create_backup",
+                                      "read_gzip_1", "write_gzip_1", "mixed_0.5"})
+        self.assertTrue(all(0 < result["file_ratio"] < 1 for result in results["results"] if "file_ratio" in result))
+        self.assertIsNone(Database.compression)
+        self.assertTrue(all(result["operations"] > 0 and result["p99_ms"] >= result["p50_ms"]
+                            for result in results["results"]))
+        self.assertEqual(len(benchmark_database_manager.compare(results, json.loads(json.dumps(results)))),
+                         len(results["results"]))
+        self.assertEqual(Database.my_path, os.path.dirname(os.path.realpath(benchmark_database_manager.__file__)))
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.create(test_name, test_data, replace=True)
+
+    def tearDown(self) -> None:
+        Database.compression = None
+        Database.compressions.clear()
+        if os.path.exists(Database.backup_folder_path):
+            shutil.rmtree(Database.backup_folder_path)
+        os.remove(test_filename)
+
+    def test_compressions(self):
+        for compression, magic in (("gzip", b"\x1f\x8b"), ("lzma", b"\xfd7zXZ"), ("zstd", b"\x28\xb5\x2f\xfd")):
+            if compression == "zstd" and zstandard is None:
+                continue
+            Database.compressions[test_name] = compression
+            Database.write(test_name, test_data)
+            with open(test_filename, "rb") as f:
+                self.assertTrue(f.read().startswith(magic))
+            Database.add(test_name, "new", compression)
+            self.assertEqual(Database.read(test_name), dict(test_data, new=compression))
+            self.assertEqual(Database.get_path(test_name, "dict.test"), "data")
+            self.assertEqual(dict(Database.lazy(test_name)), dict(test_data, new=compression))
+        Database.compressions.clear()
+        Database.write(test_name, test_data)  # Back to plain json
+        with open(test_filename) as f:
+            self.assertEqual(json.load(f), test_data)
+
+    def test_compressed_backups(self):
+        Database.create_backup([test_name])
+        Database.create_backup([test_name])
+        first, second = Database.list_backups()
+        first_file = os.path.join(Database.backup_folder_path, first, test_filename)
+        with open(first_file, "rb") as f:
+            self.assertEqual(json.loads(gzip.decompress(f.read())), test_data)
+        self.assertTrue(os.path.samefile(first_file, os.path.join(Database.backup_folder_path, second, test_filename)))
+        Database.write(test_name, {})
+        Database.restore_backup(first)
+        with open(test_filename) as f:  # Restored as plain json because compression is off
+            self.assertEqual(json.load(f), test_data)
+
+    def test_compressed_document_backup_is_linked(self):
+        Database.compression = "lzma"
+        Database.write(test_name, test_data)
+        Database.create_backup([test_name])
+        backup = os.path.join(Database.backup_folder_path, Database.list_backups()[0], test_filename)
+        self.assertTrue(os.path.samefile(backup, test_filename))
+
+
+class TestSchemas(unittest.TestCase):
+    def setUp(self) -> None:
+        self.users = {"quinten": {"name": "quinten", "age": 20, "status": "cool", "profile": {"city": "Amsterdam"}}}
+        Database.create(test_name, self.users, replace=True, schema=Dict[str, User])
+
+    def tearDown(self) -> None:
+        Database.schemas.clear()
+        Database.journal = False
+        os.remove(test_filename)
+        if os.path.exists(test_name + ".wal"):
+            os.remove(test_name + ".wal")
+
+    def test_writes_are_checked(self):
+        Database.add(test_name, "bob", User("bob", 30, "uncool", None))
+        self.users["bob"] = {"name": "bob", "age": 30, "status": "uncool", "profile": None}
+        self.assertEqual(Database.read(test_name), self.users)
+        for record, message in ((User("x", True, "cool", None), "age should be int, not bool"),
+                                ({"name": "x", "age": 1, "status": "meh", "profile": None}, "status should be one of"),
+                                ({"name": "x", "age": 1, "status": "cool", "profile": {"city": 1}},
+                                 "profile.city should be str, not int"),
+                                ({"name": "x", "age": 1, "status": "cool"}, "profile is missing"),
+                                ({"name": "x", "age": 1, "status": "cool", "profile": None, "x": 1}, "x is not a field")):
+            with self.assertRaises(TypeError) as error:
+                Database.add(test_name, "x", record)
+            self.assertIn(f"{test_name}.x.{message}", str(error.exception))
+        with self.assertRaises(TypeError):
+            with Database(test_name) as db:
+                db["quinten"]["age"] = "old"
+        with self.assertRaises(TypeError):
+            Database.write(test_name, {"bob": {}})
+        self.assertEqual(Database.read(test_name), self.users)
+
+    def test_only_changed_keys_are_checked(self):
+        Database.schemas.clear()
+        Database.add(test_name, "broken", {"name": 1})
+        Database.schemas[test_name] = Dict[str, User]
+        with Database(test_name) as db:
+            db["quinten"]["age"] += 1
+            db["bob"] = User("bob", 30, "cool", Profile("Utrecht"))
+        self.assertEqual(Database.read(test_name)["bob"]["profile"], {"city": "Utrecht"})
+        with self.assertRaises(TypeError):
+            with Database(test_name) as db:
+                db["broken"]["age"] = 1
+        with self.assertRaises(TypeError):
+            Database.write(test_name, Database.read(test_name))
+
+    def test_read_typed(self):
+        users = Database.read_typed(test_name)
+        self.assertEqual(users, {"quinten": User("quinten", 20, "cool", Profile("Amsterdam"))})
+        self.assertFalse(hasattr(users["quinten"], "__dict__"))
+        with self.assertRaises(AssertionError):
+            Database.schemas.clear()
+            Database.read_typed(test_name)
+
+    def test_dataclass_document(self):
+        Database.create(test_name, Settings("dark"), replace=True, schema=Settings)
+        Database.journal = True
+        Database.add(test_name, "events", [1])
+        with self.assertRaises(TypeError):
+            Database.append(test_name, 1)  # The list named after the document is not a field of Settings
+        with self.assertRaises(TypeError):
+            Database.delete(test_name, "theme")
+        with self.assertRaises(TypeError):
+            Database.add_many(test_name, {"theme": "light", "events": ["2"]})
+        self.assertEqual(Database.read_typed(test_name), Settings("dark", [1]))
+
+    def test_append_items_are_checked(self):
+        Database.create(test_name, {test_name: []}, replace=True, schema=Dict[str, List[int]])
+        Database.append(test_name, 1)
+        with self.assertRaises(TypeError) as error:
+            Database.append(test_name, "2")
+        self.assertIn(f"{test_name}.{test_name}[] should be int", str(error.exception))
+        self.assertEqual(Database.read(test_name), {test_name: [1]})
+
+    def test_transaction_is_checked(self):
+        Database.create(test_name + "2", {"theme": "dark"}, replace=True, schema=Settings)
+        try:
+            with self.assertRaises(TypeError):
+                with Database.transaction([test_name, test_name + "2"]) as documents:
+                    documents[test_name]["quinten"]["age"] = 21
+                    documents[test_name + "2"]["theme"] = None
+            self.assertEqual(Database.read(test_name), self.users)
+            self.assertEqual(Database.read(test_name + "2"), {"theme": "dark"})
+        finally:
+            os.remove(test_name + "2.json")
+
+
 class TestCreateBackups(unittest.TestCase):
     def setUp(self) -> None:
         """ Create a ___testing.json
@@ -247,16 +1529,16 @@ class TestDBCreate(unittest.TestCase):
             # is the lock added
             self.assertIn(test_name, Database.locks)
 
+        # does replace=True/False work. Writes replace the file so it has to be opened after the create.
+        Database.create(test_name, {"hi": "there!"})  # Should not be created!
         with open(test_filename) as f:
-            # does replace=True/False work
-            Database.create(test_name, {"hi": "there!"})  # Should not be created!
             self.assertEqual(json.load(f), test_data)
+        Database.create(test_name, {"hi": "there"}, replace=True)
         with open(test_filename) as f:
-            Database.create(test_name, {"hi": "there"}, replace=True)
             self.assertEqual(json.load(f), {"hi": "there"})
 
+        Database.create(test_name, {"hi": "there2"})
         with open(test_filename) as f:
-            Database.create(test_name, {"hi": "there2"})
             self.assertEqual(json.load(f), {"hi": "there"})
 
     def tearDown(self) -> None: